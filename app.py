@@ -1,5 +1,6 @@
 import os
 import sys
+import shlex
 import shutil
 import requests
 import subprocess
@@ -601,6 +602,74 @@ class LoginWindow(QWidget):
         except Exception as e:
             logging.error(f"Error backing up existing hooks: {e}")
 
+    def resolve_hook_interpreter(self):
+        """Find the Python 3 the hooks will run and the fastest flags that work, as (path, flags) or None."""
+        if platform.system() == "Windows":
+            pycache_dir = os.path.join(os.path.expanduser("~"), ".genie", "pycache")
+        else:
+            pycache_dir = os.path.expanduser("~/.genie/pycache")
+        
+        # The hooks only use the standard library, but HTTPS needs ssl
+        check = ("import sys, json, ssl, subprocess, http.client, urllib.request; "
+                 "assert sys.version_info >= (3, 9); print(sys.executable)")
+        
+        for candidate in (["python3"], ["python"], ["py", "-3"]):
+            if not shutil.which(candidate[0]):
+                continue
+            for flags in (["-I", "-S"], ["-I"], []):
+                flags = flags + ["-X", f"pycache_prefix={pycache_dir}"]
+                try:
+                    result = run_subprocess(candidate + flags + ["-c", check],
+                                            capture_output=True, text=True, timeout=30, check=False)
+                except (OSError, subprocess.TimeoutExpired) as e:
+                    logging.warning(f"Could not run {candidate[0]}: {e}")
+                    break
+                executable = result.stdout.strip()
+                if result.returncode == 0 and os.path.isabs(executable):
+                    return executable, flags
+                logging.info(f"{' '.join(candidate + flags)} is not usable for the hooks: {result.stderr.strip()[-200:]}")
+        
+        return None
+
+    def bake_hook_wrapper(self, wrapper_content, hooks_dir, interpreter):
+        """Fill in the interpreter, flags and hook directory placeholders of a wrapper script"""
+        def bash_path(value):
+            # Forward slashes work in Git Bash too; escape what is special inside double quotes
+            value = value.replace("\\", "/")
+            for char in ('$', '`', '"'):
+                value = value.replace(char, "\\" + char)
+            return value
+        
+        if interpreter:
+            python_path, flags = interpreter
+            wrapper_content = wrapper_content.replace("@GENIE_PYTHON@", bash_path(python_path))
+            wrapper_content = wrapper_content.replace(
+                "@GENIE_PYTHON_FLAGS@", " ".join(shlex.quote(flag.replace("\\", "/")) for flag in flags))
+        return wrapper_content.replace("@GENIE_HOOKS_DIR@", bash_path(os.path.abspath(hooks_dir)))
+
+    def install_hook_bundle(self, hooks_base, hooks_dir, interpreter):
+        """Precompile both hooks into genie-hooks.pyz, removing a bundle that cannot be rebuilt."""
+        bundle_path = os.path.join(hooks_dir, "genie-hooks.pyz")
+        builder = os.path.abspath(os.path.join(hooks_base, "build_bundle.py"))
+        try:
+            if not interpreter:
+                raise RuntimeError("no Python 3 to build it for")
+            python_path, flags = interpreter
+            result = run_subprocess([python_path, *flags, builder, bundle_path],
+                                    capture_output=True, text=True, timeout=120, check=False)
+            if result.returncode != 0:
+                raise RuntimeError((result.stdout + result.stderr).strip()[-300:])
+            logging.info(result.stdout.strip())
+            return True
+        except (OSError, RuntimeError, subprocess.TimeoutExpired) as e:
+            logging.warning(f"Hooks will run from plain scripts, the bundle was not built: {e}")
+            try:
+                if os.path.exists(bundle_path):
+                    os.remove(bundle_path)
+            except OSError as e:
+                logging.error(f"Could not remove the outdated hook bundle {bundle_path}: {e}")
+            return False
+
     def install_hooks_safely(self, hooks_dir):
         """Install Genie hooks without overwriting other applications' hooks."""
         try:
@@ -610,6 +679,13 @@ class LoginWindow(QWidget):
             # Backup existing hooks first
             self.backup_existing_hooks(hooks_dir)
             
+            # Resolve the interpreter once here; the wrappers only probe again if it disappears
+            interpreter = self.resolve_hook_interpreter()
+            if interpreter:
+                logging.info(f"Hooks will run: {interpreter[0]} {' '.join(interpreter[1])}")
+            else:
+                logging.warning("No usable Python 3 found; the hook wrappers will look for one on each commit")
+            
             genie_signature = "# GENIE_GITHOOKS_MARKER"
             
             # Define source paths - handle both development and packaged app
@@ -654,7 +730,7 @@ class LoginWindow(QWidget):
                 if platform.system().lower() == 'windows':
                     wrapper_content = wrapper_content.replace('\r\n', '\n').replace('\r', '\n')
                 
-                # No need to replace placeholders - hooks read from config file
+                wrapper_content = self.bake_hook_wrapper(wrapper_content, hooks_dir, interpreter)
                 
                 # Install the Python script
                 with open(pre_commit_py_source, "r", encoding="utf-8") as file:
@@ -729,7 +805,7 @@ fi
                 if platform.system().lower() == 'windows':
                     wrapper_content = wrapper_content.replace('\r\n', '\n').replace('\r', '\n')
                 
-                # No need to replace placeholders - hooks read from config file
+                wrapper_content = self.bake_hook_wrapper(wrapper_content, hooks_dir, interpreter)
                 
                 # Install the Python script
                 with open(post_commit_py_source, "r", encoding="utf-8") as file:
@@ -787,6 +863,9 @@ fi
                     
                 logging.info("Post-commit hook installed safely!")
             
+            # Precompile both hooks for the baked interpreter
+            self.install_hook_bundle(hooks_base, hooks_dir, interpreter)
+            
             platform_msg = ""
             if platform.system().lower() == 'windows':
                 platform_msg = "✅ Bash scripts with Windows line ending fixes\n✅ Support for Windows GUI tools (VSCode, GitHub Desktop)\n✅ Windows Python launcher (py.exe) detection\n"
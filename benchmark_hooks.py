@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""
+Genie GitHooks - Hook benchmarks
+Developer tool for measuring hook latency. Run `git-info` from inside a Git
+repository that has staged changes; `startup` builds its own scratch repo:
+
+    python /path/to/benchmark_hooks.py git-info --runs 20
+    python /path/to/benchmark_hooks.py startup --budget-ms 25
+    python /path/to/benchmark_hooks.py bundle --runs 20
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+import subprocess
+import importlib.util
+
+HOOKS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "hooks")
+
+def load_hook(name):
+    """Load a hook script (e.g. pre-commit.py) as a module"""
+    path = os.path.join(HOOKS_DIR, f"{name}.py")
+    spec = importlib.util.spec_from_file_location(name.replace('-', '_'), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def time_runs(func, runs):
+    """Run func `runs` times and return the durations in milliseconds"""
+    durations = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        func()
+        durations.append((time.perf_counter() - start) * 1000)
+    return durations
+
+def print_timings(label, durations):
+    """Print min/median/mean for a list of durations"""
+    print(f"{label:<28} min {min(durations):8.1f} ms   "
+          f"median {statistics.median(durations):8.1f} ms   "
+          f"mean {statistics.mean(durations):8.1f} ms")
+
+def legacy_git_info():
+    """The pre-single-pass code path: six serial git processes"""
+    subprocess.run(['git', 'config', '--global', '--get', 'user.name'],
+                   capture_output=True, text=True, check=False)
+    subprocess.run(['git', 'config', '--global', '--get', 'user.email'],
+                   capture_output=True, text=True, check=False)
+    subprocess.run(['git', 'diff', '--cached', '--name-only'],
+                   capture_output=True, text=True, check=True)
+    subprocess.run(['git', 'diff', '--cached'],
+                   capture_output=True, text=True, check=True)
+    subprocess.run(['git', 'config', '--get', 'remote.origin.url'],
+                   capture_output=True, text=True, check=False)
+    subprocess.run(['git', 'rev-parse', '--abbrev-ref', 'HEAD'],
+                   capture_output=True, text=True, check=True)
+
+def bench_git_info(args):
+    """Compare the legacy git collection against the single-pass collector"""
+    hook = load_hook("pre-commit")
+
+    def single_pass():
+        hook._git_config_cache = None
+        hook.read_git_config()
+        hook.collect_staged_changes()
+
+    # Warm the OS caches so neither side pays for the first index read
+    legacy_git_info()
+    single_pass()
+
+    legacy = time_runs(legacy_git_info, args.runs)
+    current = time_runs(single_pass, args.runs)
+
+    print(f"Staged-change collection over {args.runs} runs in {os.getcwd()}")
+    print_timings("legacy (6 git processes)", legacy)
+    print_timings("single pass (2 processes)", current)
+    print(f"Speedup (median): {statistics.median(legacy) / statistics.median(current):.2f}x")
+    return 0
+
+def read_import_times(stderr):
+    """Cumulative microseconds per top-level import from `python -X importtime` output"""
+    imports = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # Nested imports are indented under the module that pulled them in
+        if cumulative.strip().isdigit() and not name.startswith('  '):
+            imports[name.strip()] = imports.get(name.strip(), 0) + int(cumulative)
+    return imports
+
+def run_importtime(argv, env, cwd):
+    """Run a Python command with -X importtime; returns (wall ms, top-level imports, stdout)"""
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime'] + argv, env=env, cwd=cwd,
+                            capture_output=True, text=True, check=False)
+    return (time.perf_counter() - start) * 1000, read_import_times(result.stderr), result.stdout
+
+def make_noop_repo(scratch):
+    """A configured HOME and an empty repo under `scratch`, where the hook stops at "No files staged" """
+    home = os.path.join(scratch, 'home')
+    repo = os.path.join(scratch, 'repo')
+    os.makedirs(os.path.join(home, '.genie'))
+    with open(os.path.join(home, '.genie', 'config'), 'w', encoding='utf-8') as f:
+        f.write('http://127.0.0.1:9\n')
+    with open(os.path.join(home, '.gitconfig'), 'w', encoding='utf-8') as f:
+        f.write('[user]\n\tname = Benchmark\n\temail = benchmark@example.com\n')
+    env = {name: value for name, value in os.environ.items() if not name.startswith(('GENIE_', 'GIT_'))}
+    env.update(HOME=home, GENIE_MESSAGE_BOX='console')
+    subprocess.run(['git', 'init', '-q', repo], env=env, check=True)
+    return env, repo
+
+def bench_startup(args):
+    """Time the no-op path ("No files staged") and fail if its imports exceed the budget"""
+    scratch = tempfile.mkdtemp(prefix='genie-startup-')
+    hook = os.path.join(HOOKS_DIR, f"{args.hook}.py")
+    
+    try:
+        env, repo = make_noop_repo(scratch)
+        # Modules the bare interpreter loads anyway are not the hook's doing
+        _, interpreter, _ = run_importtime(['-c', 'pass'], env, repo)
+        walls, totals, heaviest = [], [], {}
+        for _ in range(args.runs):
+            wall, imports, stdout = run_importtime([hook], env, repo)
+            if 'No files staged' not in stdout:
+                print(f"ERROR: {args.hook} did not take the no-op path:\n{stdout}")
+                return 1
+            own = {name: micros for name, micros in imports.items() if name not in interpreter}
+            walls.append(wall)
+            totals.append(sum(own.values()) / 1000)
+            for name, micros in own.items():
+                heaviest.setdefault(name, []).append(micros / 1000)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+    
+    print(f"No-op {args.hook} startup over {args.runs} runs ({sys.executable})")
+    print_timings("wall clock", walls)
+    print_timings("hook imports", totals)
+    print("Heaviest imports (median):")
+    for name, times in sorted(heaviest.items(), key=lambda item: -statistics.median(item[1]))[:args.top]:
+        print(f"  {name:<26} {statistics.median(times):8.1f} ms")
+    
+    median = statistics.median(totals)
+    if median > args.budget_ms:
+        print(f"FAIL: imports take {median:.1f} ms, over the {args.budget_ms:.1f} ms budget")
+        return 1
+    print(f"OK: imports take {median:.1f} ms, within the {args.budget_ms:.1f} ms budget")
+    return 0
+
+def bench_bundle(args):
+    """Time the no-op path from the loose scripts and from the precompiled bundle"""
+    scratch = tempfile.mkdtemp(prefix='genie-bundle-')
+    bundle = os.path.join(scratch, 'genie-hooks.pyz')
+    flags = args.flags.split()
+    commands = {
+        "loose script": [sys.executable, *flags, os.path.join(HOOKS_DIR, "pre-commit.py")],
+        "bundle (.pyz)": [sys.executable, *flags, bundle, 'pre-commit'],
+    }
+    
+    try:
+        env, repo = make_noop_repo(scratch)
+        subprocess.run([sys.executable, os.path.join(HOOKS_DIR, 'build_bundle.py'), bundle],
+                       check=True, stdout=subprocess.DEVNULL)
+        timings = {}
+        for label, command in commands.items():
+            def run():
+                result = subprocess.run(command, env=env, cwd=repo, capture_output=True, text=True, check=False)
+                if 'No files staged' not in result.stdout:
+                    raise RuntimeError(f"{label} did not take the no-op path:\n{result.stdout}{result.stderr}")
+            run()
+            timings[label] = time_runs(run, args.runs)
+    except RuntimeError as e:
+        print(f"ERROR: {e}")
+        return 1
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+    
+    print(f"No-op pre-commit startup over {args.runs} runs ({sys.executable} {args.flags})")
+    for label, durations in timings.items():
+        print_timings(label, durations)
+    loose, bundled = (statistics.median(durations) for durations in timings.values())
+    print(f"Speedup (median): {loose / bundled:.2f}x")
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Genie GitHooks hook latency")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    git_info = subparsers.add_parser("git-info", help="staged-change collection: legacy vs single pass")
+    git_info.add_argument("--runs", type=int, default=10)
+    git_info.set_defaults(func=bench_git_info)
+    
+    startup = subparsers.add_parser("startup", help="no-op hook startup against an import-time budget")
+    startup.add_argument("--runs", type=int, default=10)
+    startup.add_argument("--budget-ms", type=float, default=25.0,
+                         help="fail if the median import time of the hook exceeds this")
+    startup.add_argument("--hook", default="pre-commit")
+    startup.add_argument("--top", type=int, default=8, help="number of heaviest imports to list")
+    startup.set_defaults(func=bench_startup)
+    
+    bundle = subparsers.add_parser("bundle", help="no-op hook startup: loose script vs precompiled bundle")
+    bundle.add_argument("--runs", type=int, default=20)
+    bundle.add_argument("--flags", default="-I -S", help="interpreter flags, as baked into the wrappers")
+    bundle.set_defaults(func=bench_bundle)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Genie GitHooks - Hook bundle builder
+Packs pre-commit.py and post-commit.py into one zipapp holding bytecode for
+the interpreter that runs this script, so the hooks are not compiled again
+on every commit:
+
+    python3 hooks/build_bundle.py ~/.genie/hooks/genie-hooks.pyz
+    python3 ~/.genie/hooks/genie-hooks.pyz pre-commit
+    python3 ~/.genie/hooks/genie-hooks.pyz --version
+"""
+
+import os
+import sys
+import json
+import time
+import hashlib
+import zipfile
+import tempfile
+import py_compile
+import importlib.util
+
+HOOKS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Hook name -> module name inside the bundle
+BUNDLED_HOOKS = {
+    'pre-commit': 'pre_commit',
+    'post-commit': 'post_commit',
+}
+
+BUNDLE_MAIN = '''"""Genie GitHooks bundle: python genie-hooks.pyz <pre-commit|post-commit|--version> [args]"""
+import sys
+import runpy
+
+HOOKS = %r
+
+if __name__ == "__main__":
+    hook = sys.argv.pop(1) if len(sys.argv) > 1 else ''
+    if hook == '--version':
+        import pkgutil
+        print(pkgutil.get_data('__main__', 'BUNDLE.json').decode('utf-8').strip())
+        sys.exit(0)
+    if hook not in HOOKS:
+        print(f"usage: {sys.argv[0]} <{'|'.join(HOOKS)}|--version> [args]")
+        sys.exit(2)
+    sys.argv[0] = hook
+    runpy.run_module(HOOKS[hook], run_name='__main__', alter_sys=True)
+''' % BUNDLED_HOOKS
+
+def get_bundle_version(sources):
+    """Version stamp of a bundle: a hash of the hook sources it was built from"""
+    digest = hashlib.sha256()
+    for name in sorted(sources):
+        digest.update(name.encode('utf-8') + b'\0' + sources[name] + b'\0')
+    return digest.hexdigest()[:12]
+
+def compile_module(source_path, display_name, work_dir):
+    """Unchecked hash-based bytecode for one module, used from the bundle without its source's timestamp"""
+    cfile = os.path.join(work_dir, os.path.basename(display_name) + 'c')
+    py_compile.compile(source_path, cfile=cfile, dfile=display_name, doraise=True,
+                       invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH)
+    with open(cfile, 'rb') as f:
+        return f.read()
+
+def build_bundle(output, hooks_dir=HOOKS_DIR):
+    """Write the bundle to `output` atomically and return its stamp"""
+    sources = {}
+    for hook in BUNDLED_HOOKS:
+        with open(os.path.join(hooks_dir, f'{hook}.py'), 'rb') as f:
+            sources[hook] = f.read()
+    stamp = {
+        'version': get_bundle_version(sources),
+        'python': sys.implementation.cache_tag,
+        'magic': importlib.util.MAGIC_NUMBER.hex(),
+        'built': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+    }
+
+    temp_output = f'{output}.{os.getpid()}.tmp'
+    with tempfile.TemporaryDirectory(prefix='genie-bundle-') as work_dir:
+        main_path = os.path.join(work_dir, '__main__.py')
+        with open(main_path, 'w', encoding='utf-8') as f:
+            f.write(BUNDLE_MAIN)
+
+        try:
+            with zipfile.ZipFile(temp_output, 'w', zipfile.ZIP_STORED) as bundle:
+                bundle.writestr('BUNDLE.json', json.dumps(stamp, indent=2) + '\n')
+                bundle.write(main_path, '__main__.py')
+                bundle.writestr('__main__.pyc', compile_module(main_path, '__main__.py', work_dir))
+                for hook, module in BUNDLED_HOOKS.items():
+                    # The sources stay in the bundle for tracebacks and for other interpreters
+                    source_path = os.path.join(hooks_dir, f'{hook}.py')
+                    bundle.writestr(f'{module}.py', sources[hook])
+                    bundle.writestr(f'{module}.pyc', compile_module(source_path, f'{module}.py', work_dir))
+            os.replace(temp_output, output)
+        finally:
+            if os.path.exists(temp_output):
+                os.remove(temp_output)
+    return stamp
+
+def main():
+    if len(sys.argv) != 2:
+        print(f"usage: {sys.argv[0]} <output .pyz>")
+        return 2
+    try:
+        stamp = build_bundle(os.path.abspath(sys.argv[1]))
+    except (OSError, SyntaxError, py_compile.PyCompileError) as e:
+        print(f"ERROR: Could not build the hook bundle: {e}")
+        return 1
+    print(f"Built {sys.argv[1]} version {stamp['version']} for {stamp['python']}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,77 +2,337 @@
 """
 Genie GitHooks - Post-commit Hook (Python Implementation)
 Cross-platform compatible Git post-commit hook
+
+The hook only acts on what the pre-commit hook left in <git dir>/genie/: a
+deferred review (pending.json), a finished review to link to the commit
+(review.json) or a review queued while offline (spooled). It spawns no git
+process itself; the work that needs git runs in a detached worker
+(`post-commit.py --record <commit SHA>`), so git is never held up.
 """
 
 import os
 import sys
+import time
 import subprocess
-import platform
 
-def show_message_box(message):
-    """Display a message box using tkinter"""
+# Deferred review snapshots older than this are not from the current commit
+MAX_SNAPSHOT_AGE = 3600
+
+# The commit log (<git dir>/genie/commits.jsonl) is cut to its newer half past this size
+MAX_COMMIT_LOG_BYTES = 256 * 1024
+
+# Reports kept in ~/.genie/reviews; the oldest are removed beyond this
+MAX_KEPT_REPORTS = 200
+
+def get_git_dir():
+    """Locate the .git directory without spawning git"""
+    git_dir = os.environ.get('GIT_DIR')
+    if git_dir:
+        return os.path.abspath(git_dir)
+    candidate = os.path.join(os.getcwd(), '.git')
+    if os.path.isfile(candidate):
+        # Worktrees and submodules use a "gitdir: <path>" pointer file
+        try:
+            with open(candidate, 'r', encoding='utf-8') as f:
+                content = f.read().strip()
+            if content.startswith('gitdir:'):
+                return os.path.normpath(os.path.join(os.getcwd(), content[len('gitdir:'):].strip()))
+        except OSError:
+            pass
+    return candidate
+
+def get_genie_dir(*parts):
+    """Get a path inside the per-user .genie directory"""
+    if os.name == 'nt':
+        genie_dir = os.path.join(os.path.expanduser("~"), ".genie")
+    else:
+        genie_dir = os.path.expanduser("~/.genie")
+    return os.path.join(genie_dir, *parts)
+
+def is_commit_id(value):
+    """Whether value is a full SHA-1 or SHA-256 commit ID"""
+    return len(value) in (40, 64) and all(c in '0123456789abcdef' for c in value)
+
+def read_head_commit(git_dir):
+    """The commit SHA of HEAD, read from the ref files; git is only asked when they do not have it"""
     try:
-        import tkinter as tk
-        from tkinter import messagebox
-        root = tk.Tk()
-        root.withdraw()
-        messagebox.showinfo("Genie GitHooks", message)
-    except ImportError:
-        # Fallback to console if tkinter is not available
-        print(f"GENIE GITHOOKS: {message}")
-
-def get_commit_details():
-    """Get details about the latest commit"""
+        with open(os.path.join(git_dir, 'HEAD'), 'r', encoding='utf-8') as f:
+            head = f.read().strip()
+        if head.startswith('ref: '):
+            ref = head[len('ref: '):]
+            # Linked worktrees keep branches in the common directory
+            common_dir = git_dir
+            try:
+                with open(os.path.join(git_dir, 'commondir'), 'r', encoding='utf-8') as f:
+                    common_dir = os.path.normpath(os.path.join(git_dir, f.read().strip()))
+            except OSError:
+                pass
+            head = ''
+            for directory in (git_dir, common_dir):
+                try:
+                    with open(os.path.join(directory, ref), 'r', encoding='utf-8') as f:
+                        head = f.read().strip()
+                    break
+                except OSError:
+                    pass
+            if not head:
+                with open(os.path.join(common_dir, 'packed-refs'), 'r', encoding='utf-8') as f:
+                    head = next((line.split()[0] for line in f if line.rstrip('\n').endswith(f' {ref}')), '')
+        if is_commit_id(head):
+            return head
+    except OSError:
+        pass
+    
+    # e.g. a reftable repository
+    result = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=False)
+    return result.stdout.strip()
+
+def get_commit_summary(commit_id):
+    """The commit's ID, parents, time, author, subject and {path: new blob}, from one `git log`"""
+    # Merges print no raw lines by default; -m --first-parent diffs them against the
+    # branch they were made on, as pre-commit did (--diff-merges=first-parent in git 2.31+)
+    result = subprocess.run(['git', 'log', '-1', '-z', '--root', '--raw', '--no-abbrev', '-m', '--first-parent',
+                             '--format=%H%x00%P%x00%ct%x00%an <%ae>%x00%s', commit_id],
+                          capture_output=True, text=True, encoding='utf-8', errors='replace', check=True)
+    fields = result.stdout.split('\0')
+    summary = {
+        'commit': fields[0],
+        'parents': fields[1].split(),
+        'time': int(fields[2]),
+        'author': fields[3],
+        'subject': fields[4],
+        'blobs': {},
+    }
+    i = 5
+    while i < len(fields):
+        record = fields[i].lstrip('\n')
+        if not record.startswith(':'):
+            i += 1
+            continue
+        # ":<old mode> <new mode> <old blob> <new blob> <status>" then one path, two for renames/copies
+        words = record.split()
+        paths = 2 if words[-1][:1] in ('R', 'C') else 1
+        summary['blobs'][fields[i + paths]] = words[3]
+        i += paths + 1
+    return summary
+
+def matches_commit(snapshot, summary):
+    """Whether something the pre-commit hook saved was made for this commit"""
+    if time.time() - snapshot.get('created', 0) >= MAX_SNAPSHOT_AGE:
+        return False
+    # e.g. a commit made with --no-verify after an aborted one
+    if snapshot.get('parents') != summary['parents']:
+        return False
+    # An amend or a merge resolution was diffed against another tree than the first
+    # parent, so a file it changed may be back at the parent's blob and not in the commit
+    lenient = snapshot.get('amend') or snapshot.get('base')
+    blobs = summary['blobs']
+    return all(blobs.get(path) == blob or (lenient and path not in blobs)
+               for path, blob in (snapshot.get('files') or {}).items())
+
+def read_claimed_file(path):
+    """Load and remove a JSON file claimed for this commit"""
+    import json
+    
     try:
-        # Get commit ID
-        result = subprocess.run(['git', 'rev-parse', 'HEAD'], 
-                              capture_output=True, text=True, check=True)
-        commit_id = result.stdout.strip()
-        
-        # Get commit message
-        result = subprocess.run(['git', 'log', '--format=%B', '-n', '1', commit_id], 
-                              capture_output=True, text=True, check=True)
-        commit_message = result.stdout.strip()
-        
-        # Get branch name
-        result = subprocess.run(['git', 'rev-parse', '--abbrev-ref', 'HEAD'], 
-                              capture_output=True, text=True, check=True)
-        branch = result.stdout.strip()
-        
-        # Get repo name
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    finally:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    return data
+
+# Variables git sets for this commit only; a detached worker outlives them
+COMMIT_GIT_ENV = ('GIT_INDEX_FILE', 'GIT_DIR', 'GIT_WORK_TREE', 'GIT_PREFIX')
+
+def start_detached(command, log_file):
+    """Start a process that outlives the hook, appending its output to log_file"""
+    env = {name: value for name, value in os.environ.items() if name not in COMMIT_GIT_ENV}
+    options = {}
+    if os.name == 'nt':
+        options['creationflags'] = subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP
+    else:
+        options['start_new_session'] = True
+    with open(log_file, 'a', encoding='utf-8') as log:
+        subprocess.Popen([sys.executable, *command], env=env, stdin=subprocess.DEVNULL, stdout=log,
+                         stderr=subprocess.STDOUT, **options)
+
+def get_hook_command(hook):
+    """Arguments that run a hook script, from the loose scripts or the installed bundle"""
+    hooks_dir = os.path.dirname(os.path.abspath(__file__))
+    if os.path.isfile(hooks_dir):
+        # Loaded from <hooks dir>/genie-hooks.pyz/post_commit.pyc
+        return [hooks_dir, hook]
+    return [os.path.join(hooks_dir, f'{hook}.py')]
+
+def start_deferred_review(review_dir, summary):
+    """Check the claimed deferred review against the commit and start its detached worker"""
+    commit_id = summary['commit']
+    snapshot = read_claimed_file(os.path.join(review_dir, f'{commit_id}.pending.json'))
+    if not snapshot:
+        return
+    
+    changes = snapshot.get('changes', {})
+    staged = {record['path']: record['new_blob'] for record in changes.get('files', [])}
+    if not matches_commit(dict(changes, created=snapshot.get('created', 0), files=staged), summary):
+        print("Warning: Discarding a deferred review that does not match this commit")
+        return
+    
+    snapshot_file = os.path.join(review_dir, f'{commit_id}.json')
+    write_json_file(snapshot_file, snapshot)
+    start_detached(get_hook_command('pre-commit') + ['--review-commit', snapshot_file],
+                   os.path.join(review_dir, f'{commit_id}.log'))
+    print(f"Started the deferred review of {commit_id[:12]}")
+
+def link_review(review_dir, summary, started):
+    """Log the commit's review, report and phase timings in <git dir>/genie/commits.jsonl"""
+    import shutil
+    
+    commit_id = summary['commit']
+    record = read_claimed_file(os.path.join(review_dir, f'{commit_id}.review.json'))
+    if not record:
+        return
+    if not matches_commit(record, summary):
+        print("Warning: Not linking a review that does not match this commit")
+        return
+    
+    report = record.get('report')
+    if report and os.path.isfile(report):
+        try:
+            os.makedirs(get_genie_dir('reviews'), exist_ok=True)
+            shutil.copyfile(report, get_genie_dir('reviews', f'{commit_id}.html'))
+            report = get_genie_dir('reviews', f'{commit_id}.html')
+            prune_kept_reports()
+        except OSError as e:
+            print(f"Warning: Could not keep the review report: {e}")
+    
+    timings = dict(record.get('timings') or {})
+    timings['post_commit'] = round((time.perf_counter() - started) * 1000, 1)
+    entry = {key: summary[key] for key in ('commit', 'parents', 'time', 'author', 'subject')}
+    entry.update(branch=record.get('branch'), report=report, timings=timings)
+    append_commit_log(os.path.join(review_dir, 'commits.jsonl'), entry)
+    print(f"Linked {commit_id[:12]} to its review: {report}")
+
+def write_json_file(path, data):
+    """Atomically replace a JSON file"""
+    import json
+    
+    temp_file = f'{path}.{os.getpid()}.tmp'
+    with open(temp_file, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    os.replace(temp_file, path)
+
+def append_commit_log(path, entry):
+    """Append one JSON line to the commit log, dropping its older half once it grows too large"""
+    import json
+    
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(entry) + '\n')
+    if os.path.getsize(path) > MAX_COMMIT_LOG_BYTES:
+        with open(path, 'r', encoding='utf-8') as f:
+            lines = f.readlines()
+        with open(f'{path}.tmp', 'w', encoding='utf-8') as f:
+            f.writelines(lines[len(lines) // 2:])
+        os.replace(f'{path}.tmp', path)
+
+def prune_deferred_reviews(review_dir, max_age_days=7):
+    """Remove snapshots and worker logs of old deferred reviews"""
+    cutoff = time.time() - max_age_days * 86400
+    for name in os.listdir(review_dir):
+        path = os.path.join(review_dir, name)
+        try:
+            if name not in ('pending.json', 'review.json', 'commits.jsonl') and os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
+
+def prune_kept_reports(max_reports=MAX_KEPT_REPORTS):
+    """Remove the oldest reports in ~/.genie/reviews beyond max_reports"""
+    reports = []
+    for entry in os.scandir(get_genie_dir('reviews')):
         try:
-            result = subprocess.run(['git', 'config', '--get', 'remote.origin.url'], 
-                                  capture_output=True, text=True, check=False)
-            if result.stdout:
-                repo_name = result.stdout.strip().split('/')[-1].replace('.git', '')
-            else:
-                repo_name = os.path.basename(os.getcwd())
-        except:
-            repo_name = os.path.basename(os.getcwd())
-        
-        return commit_id, commit_message, branch, repo_name
-        
-    except subprocess.CalledProcessError as e:
+            if entry.name.endswith('.html'):
+                reports.append((entry.stat().st_mtime, entry.path))
+        except OSError:
+            pass
+    for _, path in sorted(reports)[:-max_reports]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def link_spooled_review(review_dir, commit_id):
+    """Record the new commit SHA in the review the pre-commit hook queued while offline"""
+    import json
+    
+    marker = os.path.join(review_dir, 'spooled')
+    try:
+        with open(marker, 'r', encoding='utf-8') as f:
+            name = f.read().strip()
+        os.remove(marker)
+    except OSError:
+        return
+    entry_file = get_genie_dir('spool', name)
+    try:
+        with open(entry_file, 'r', encoding='utf-8') as f:
+            entry = json.load(f)
+        entry['commit'] = commit_id
+        write_json_file(entry_file, entry)
+    except (OSError, ValueError):
+        # Already replayed or dropped from the queue
+        pass
+
+def record_commit(commit_id):
+    """Detached worker: read the commit once, then start its deferred review and link its review"""
+    started = time.perf_counter()
+    review_dir = os.path.join(get_git_dir(), 'genie')
+    try:
+        summary = get_commit_summary(commit_id)
+    except (subprocess.CalledProcessError, OSError, IndexError, ValueError) as e:
         print(f"Git command failed: {e}")
-        return "", "", "", ""
+        return 1
+    
+    start_deferred_review(review_dir, summary)
+    link_review(review_dir, summary, started)
+    prune_deferred_reviews(review_dir)
+    return 0
 
 def main():
-    """Main post-commit hook logic"""
-    # Get commit details
-    commit_id, commit_message, branch, repo_name = get_commit_details()
-    
-    # Display commit information
-    # print("Commit completed successfully!")
-    # print(f"Commit ID: {commit_id}")
-    # print(f"Branch: {branch}")
-    # print(f"Repository: {repo_name}")
-    # print(f"Message: {commit_message}")
+    """Main post-commit hook logic: claim what the pre-commit hook left and hand it to a worker"""
+    review_dir = os.path.join(get_git_dir(), 'genie')
+    found = [name for name in ('pending.json', 'review.json', 'spooled')
+             if os.path.exists(os.path.join(review_dir, name))]
+    if not found:
+        return 0
     
-    # Optional: Show completion message
-    # show_message_box(f"Commit completed successfully in branch: {branch}")
+    commit_id = read_head_commit(get_git_dir())
+    if not commit_id:
+        return 0
+    if 'spooled' in found:
+        link_spooled_review(review_dir, commit_id)
     
+    # Rename under the commit SHA now, so the next commit (e.g. in a rebase) cannot take them over
+    claimed = False
+    for name in ('pending.json', 'review.json'):
+        if name in found:
+            try:
+                os.replace(os.path.join(review_dir, name), os.path.join(review_dir, f'{commit_id}.{name}'))
+                claimed = True
+            except OSError:
+                pass
+    if claimed:
+        start_detached(get_hook_command('post-commit') + ['--record', commit_id],
+                       os.path.join(review_dir, f'{commit_id}.log'))
+        if 'pending.json' in found:
+            print(f"Genie review of {commit_id[:12]} starts in the background")
     return 0
 
 if __name__ == "__main__":
+    if sys.argv[1:2] == ['--record']:
+        sys.exit(record_commit(sys.argv[2]))
     exit_code = main()
-    sys.exit(exit_code) 
\ No newline at end of file
+    sys.exit(exit_code)
@@ -5,130 +5,191 @@ Cross-platform compatible Git pre-commit hook for code review
 """
 
 import os
+import re
 import sys
-import json
+import time
+import threading
 import subprocess
-import tempfile
-import platform
-import webbrowser
-import urllib.request
-import urllib.parse
-import urllib.error
 
 def show_message_box(message):
-    """Display a message box using tkinter"""
+    """Show a message on the console, or in a dialog as genie.messageBox (auto, console or dialog) says"""
+    mode = get_setting('messageBox', 'auto').lower()
+    headless = sys.platform.startswith('linux') and not (os.environ.get('DISPLAY') or os.environ.get('WAYLAND_DISPLAY'))
+    if mode == 'console' or (mode == 'auto' and (sys.stderr.isatty() or headless)):
+        print(f"GENIE GITHOOKS: {message}")
+        return
     try:
         import tkinter as tk
         from tkinter import messagebox
         root = tk.Tk()
         root.withdraw()
         messagebox.showinfo("Genie GitHooks", message)
-    except ImportError:
-        # Fallback to console if tkinter is not available
+        root.destroy()
+    except Exception:
+        # No tkinter, or no display to open it on
         print(f"GENIE GITHOOKS: {message}")
 
-def detect_language(files):
-    """Detect programming language from file extensions"""
-    if not files:
-        return 'unknown'
-    
-    # Check for special file patterns first
-    special_files = {
-        'requirements.txt': 'python',
-        'pyproject.toml': 'python',
-        'setup.py': 'python',
-        'setup.cfg': 'python',
-        'pipfile': 'python',
-        'pipfile.lock': 'python',
-        'poetry.lock': 'python',
-        'conda.yaml': 'python',
-        'environment.yml': 'python',
-        'package.json': 'javascript',
-        'package-lock.json': 'javascript',
-        'yarn.lock': 'javascript',
-        'bower.json': 'javascript',
-        'webpack.config.js': 'javascript',
-        'gulpfile.js': 'javascript',
-        'gruntfile.js': 'javascript',
-        'dockerfile': 'docker',
-        'docker-compose.yml': 'docker',
-        'docker-compose.yaml': 'docker',
-        'makefile': 'makefile',
-        'rakefile': 'ruby',
-        'gemfile': 'ruby',
-        'gemfile.lock': 'ruby',
-        'cargo.toml': 'rust',
-        'cargo.lock': 'rust',
-        'pom.xml': 'java',
-        'build.gradle': 'java',
-        'composer.json': 'php',
-        'composer.lock': 'php'
-    }
-    
-    # Check if any files match special patterns
-    for file in files:
-        filename = os.path.basename(file).lower()
-        if filename in special_files:
-            return special_files[filename]
-    
-    # Extension-based detection
-    extensions = {}
-    for file in files:
-        if '.' in file:
-            ext = file.split('.')[-1].lower()
-            extensions[ext] = extensions.get(ext, 0) + 1
-    
-    # Enhanced language mapping
-    lang_map = {
-        'py': 'python', 'pyx': 'python', 'pyi': 'python',
-        'js': 'javascript', 'jsx': 'javascript',
-        'ts': 'typescript', 'tsx': 'typescript',
-        'java': 'java', 'class': 'java', 'jar': 'java',
-        'cpp': 'cpp', 'cxx': 'cpp', 'cc': 'cpp',
-        'c': 'c', 'h': 'c', 'hpp': 'cpp',
-        'cs': 'csharp',
-        'php': 'php', 'php3': 'php', 'php4': 'php', 'php5': 'php',
-        'rb': 'ruby', 'ruby': 'ruby',
-        'go': 'go', 'rs': 'rust',
-        'kt': 'kotlin', 'kts': 'kotlin',
-        'swift': 'swift',
-        'html': 'html', 'htm': 'html',
-        'css': 'css', 'scss': 'scss', 'sass': 'scss', 'less': 'css',
-        'sql': 'sql', 'mysql': 'sql', 'postgresql': 'sql',
-        'sh': 'bash', 'bash': 'bash', 'zsh': 'bash', 'fish': 'bash',
-        'yml': 'yaml', 'yaml': 'yaml',
-        'json': 'json', 'jsonc': 'json',
-        'xml': 'xml', 'xsd': 'xml', 'xsl': 'xml',
-        'md': 'markdown', 'markdown': 'markdown',
-        'txt': 'text', 'text': 'text', 'log': 'text',
-        'cfg': 'text', 'conf': 'text', 'config': 'text',
-        'ini': 'text', 'properties': 'text', 'env': 'text',
-        'toml': 'toml', 'dockerfile': 'docker',
-        'makefile': 'makefile', 'mk': 'makefile'
-    }
+# Language lookup index, built once at import time
+SPECIAL_FILE_LANGUAGES = {
+    'requirements.txt': 'python',
+    'pyproject.toml': 'python',
+    'setup.py': 'python',
+    'setup.cfg': 'python',
+    'pipfile': 'python',
+    'pipfile.lock': 'python',
+    'poetry.lock': 'python',
+    'conda.yaml': 'python',
+    'environment.yml': 'python',
+    'package.json': 'javascript',
+    'package-lock.json': 'javascript',
+    'yarn.lock': 'javascript',
+    'bower.json': 'javascript',
+    'webpack.config.js': 'javascript',
+    'gulpfile.js': 'javascript',
+    'gruntfile.js': 'javascript',
+    'dockerfile': 'docker',
+    'docker-compose.yml': 'docker',
+    'docker-compose.yaml': 'docker',
+    'makefile': 'makefile',
+    'rakefile': 'ruby',
+    'gemfile': 'ruby',
+    'gemfile.lock': 'ruby',
+    'cargo.toml': 'rust',
+    'cargo.lock': 'rust',
+    'pom.xml': 'java',
+    'build.gradle': 'java',
+    'composer.json': 'php',
+    'composer.lock': 'php'
+}
+
+EXTENSION_LANGUAGES = {
+    'py': 'python', 'pyx': 'python', 'pyi': 'python',
+    'js': 'javascript', 'jsx': 'javascript',
+    'ts': 'typescript', 'tsx': 'typescript',
+    'java': 'java', 'class': 'java', 'jar': 'java',
+    'cpp': 'cpp', 'cxx': 'cpp', 'cc': 'cpp',
+    'c': 'c', 'h': 'c', 'hpp': 'cpp',
+    'cs': 'csharp',
+    'php': 'php', 'php3': 'php', 'php4': 'php', 'php5': 'php',
+    'rb': 'ruby', 'ruby': 'ruby',
+    'go': 'go', 'rs': 'rust',
+    'kt': 'kotlin', 'kts': 'kotlin',
+    'swift': 'swift',
+    'html': 'html', 'htm': 'html',
+    'css': 'css', 'scss': 'scss', 'sass': 'scss', 'less': 'css',
+    'sql': 'sql', 'mysql': 'sql', 'postgresql': 'sql',
+    'sh': 'bash', 'bash': 'bash', 'zsh': 'bash', 'fish': 'bash',
+    'yml': 'yaml', 'yaml': 'yaml',
+    'json': 'json', 'jsonc': 'json',
+    'xml': 'xml', 'xsd': 'xml', 'xsl': 'xml',
+    'md': 'markdown', 'markdown': 'markdown',
+    'txt': 'text', 'text': 'text', 'log': 'text',
+    'cfg': 'text', 'conf': 'text', 'config': 'text',
+    'ini': 'text', 'properties': 'text', 'env': 'text',
+    'toml': 'toml', 'dockerfile': 'docker',
+    'makefile': 'makefile', 'mk': 'makefile'
+}
+
+# Interpreter named on a "#!" line -> language
+SHEBANG_LANGUAGES = {
+    'python': 'python', 'python2': 'python', 'python3': 'python',
+    'node': 'javascript', 'nodejs': 'javascript', 'deno': 'typescript', 'ts-node': 'typescript',
+    'sh': 'bash', 'bash': 'bash', 'zsh': 'bash', 'dash': 'bash', 'ksh': 'bash', 'fish': 'bash',
+    'ruby': 'ruby', 'perl': 'perl', 'php': 'php', 'lua': 'lua', 'Rscript': 'r',
+}
+
+def detect_file_language(record):
+    """Detect a staged file's language from linguist-language, its name, its extension or its #! line"""
+    override = record.get('attributes', {}).get('linguist-language')
+    if override:
+        return override.lower()
     
-    if extensions:
-        most_common_ext = max(extensions, key=extensions.get)
-        return lang_map.get(most_common_ext, 'unknown')
+    filename = os.path.basename(record['path']).lower()
+    if filename in SPECIAL_FILE_LANGUAGES:
+        return SPECIAL_FILE_LANGUAGES[filename]
+    if filename.startswith('dockerfile') or filename.endswith('.dockerfile'):
+        return 'docker'
+    if '.' in filename:
+        language = EXTENSION_LANGUAGES.get(filename.rsplit('.', 1)[1])
+        if language:
+            return language
+    if filename in EXTENSION_LANGUAGES:
+        return EXTENSION_LANGUAGES[filename]
     
+    # "+#!/usr/bin/env python3" as the first added line of the first hunk
+    if record['hunks']:
+        first = record['hunks'][0].split('\n', 2)
+        if len(first) > 1 and first[1].startswith('+#!'):
+            words = first[1][3:].strip().split()
+            interpreter = os.path.basename(words[0]) if words else ''
+            if interpreter == 'env' and len(words) > 1:
+                interpreter = next((word for word in words[1:] if not word.startswith('-')), '')
+            language = SHEBANG_LANGUAGES.get(re.sub(r'[\d.]+$', '', interpreter)) or SHEBANG_LANGUAGES.get(interpreter)
+            if language:
+                return language
     return 'unknown'
 
+def group_language(records):
+    """The most common language among the reviewed files of a request"""
+    counts = {}
+    for record in records:
+        language = record.get('language', 'unknown')
+        if language != 'unknown' and not (record.get('excluded') or record.get('omitted')):
+            counts[language] = counts.get(language, 0) + 1
+    return max(counts, key=counts.get) if counts else 'unknown'
+
+def extract_html(api_response):
+    """Extract the HTML document from an API response (plain HTML or JSON-wrapped)"""
+    import json
+    
+    # Try to parse as JSON first
+    html_content = api_response
+    try:
+        parsed = json.loads(api_response)
+        if isinstance(parsed, dict):
+            # Check for common HTML response keys
+            for key in ['html', 'content', 'response', 'data']:
+                if key in parsed:
+                    html_content = parsed[key]
+                    break
+    except json.JSONDecodeError:
+        pass
+    return html_content
+
+def merge_review_reports(results):
+    """Merge (paths, response) review results into one HTML report; a None response marks a failed group"""
+    import html
+    
+    if len(results) == 1 and results[0][1] is not None:
+        return results[0][1]
+    
+    head = ''
+    sections = []
+    for paths, response in results:
+        title = ', '.join(paths[:5]) + (f' and {len(paths) - 5} more' if len(paths) > 5 else '')
+        if response is None:
+            body = '<p><strong>Not reviewed:</strong> the server could not be reached for these files.</p>'
+        else:
+            html_content = extract_html(response)
+            # Keep the first part's <head> so the report's styles still apply
+            head_match = re.search(r'<head[^>]*>(.*?)</head>', html_content, re.S | re.I)
+            if head_match and not head:
+                head = head_match.group(1)
+            body_match = re.search(r'<body[^>]*>(.*?)</body>', html_content, re.S | re.I)
+            body = body_match.group(1) if body_match else html_content
+        sections.append(f'<section class="genie-review-part">\n<h2>{html.escape(title)}</h2>\n{body}\n</section>')
+    
+    return ('<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8">\n' + head + '\n</head>\n<body>\n'
+            + '\n<hr>\n'.join(sections) + '\n</body>\n</html>\n')
+
 def open_html_in_browser(api_response):
-    """Extract and open HTML from API response in browser"""
+    """Extract and open HTML from API response in browser, returning the report file"""
+    import tempfile
+    import webbrowser
+    
     try:
         with tempfile.NamedTemporaryFile(mode='w', suffix='.html', delete=False, encoding='utf-8') as temp_file:
-            # Try to parse as JSON first
-            html_content = api_response
-            try:
-                parsed = json.loads(api_response)
-                if isinstance(parsed, dict):
-                    # Check for common HTML response keys
-                    for key in ['html', 'content', 'response', 'data']:
-                        if key in parsed:
-                            html_content = parsed[key]
-                            break
-            except json.JSONDecodeError:
-                pass
+            html_content = extract_html(api_response)
             
             # Write HTML to temp file
             temp_file.write(html_content)
@@ -136,49 +197,784 @@ def open_html_in_browser(api_response):
         
         # Open in browser
         webbrowser.open(f'file://{temp_file_path}')
+        return temp_file_path
         
     except Exception as e:
         print(f"Warning: Could not open review in browser: {e}")
+        return None
+
+# Report page that streamed findings are appended to while the review runs (see start_live_report)
+_live_report = None
+
+def start_live_report():
+    """Create the page streamed findings are written to; it is opened with the first finding"""
+    import tempfile
+    
+    fd, path = tempfile.mkstemp(suffix='.html', prefix='genie-review-')
+    os.close(fd)
+    return {'path': path, 'sections': {}, 'opened': False, 'lock': threading.Lock()}
+
+def write_live_report(report, final_html=None):
+    """Rewrite the live page: the findings so far (reloading every 2 s) or the final report"""
+    import html
+    
+    content = final_html
+    if content is None:
+        sections = ''.join(f'<section class="genie-review-part">\n<h2>{html.escape(title)}</h2>\n{body}\n</section>\n'
+                           for title, body in report['sections'].items())
+        content = ('<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8">\n'
+                   '<meta http-equiv="refresh" content="2">\n<title>Genie review (in progress)</title>\n</head>\n'
+                   '<body>\n<p><em>Review in progress, findings appear as they arrive.</em></p>\n'
+                   + sections + '</body>\n</html>\n')
+    # Replace the file in one step so a reload never sees half a page
+    with open(report['path'] + '.tmp', 'w', encoding='utf-8') as f:
+        f.write(content)
+    os.replace(report['path'] + '.tmp', report['path'])
+
+def add_live_finding(title, fragment):
+    """Append a streamed piece of a review to the live page, opening it on the first one"""
+    import webbrowser
+    
+    report = _live_report
+    if report is None or not fragment:
+        return
+    with report['lock']:
+        report['sections'][title] = report['sections'].get(title, '') + fragment
+        try:
+            write_live_report(report)
+            if not report['opened']:
+                report['opened'] = True
+                webbrowser.open(f'file://{report["path"]}')
+        except OSError as e:
+            print(f"Warning: Could not update the live review page: {e}")
+
+def iter_response_text(response):
+    """Yield a response body as text, piece by piece as it arrives, undoing gzip/deflate"""
+    import zlib
+    import codecs
+    
+    encoding = (response.headers.get('Content-Encoding') or '').strip().lower()
+    decompressor = None
+    if encoding in ('gzip', 'x-gzip'):
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif encoding == 'deflate':
+        decompressor = zlib.decompressobj()
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    read = getattr(response, 'read1', response.read)
+    while True:
+        raw = read(8192)
+        if not raw:
+            break
+        yield decoder.decode(decompressor.decompress(raw) if decompressor else raw)
+    yield decoder.decode(decompressor.flush() if decompressor else b'', final=True)
+
+def read_streamed_review(response, title):
+    """Read a streamed review into one HTML document, showing each piece on the live page as it arrives"""
+    event_stream = 'text/event-stream' in (response.headers.get('Content-Type') or '')
+    parts = []
+    pending = ''
+    data_lines = []
+    for text in iter_response_text(response):
+        if not event_stream:
+            parts.append(text)
+            add_live_finding(title, text)
+            continue
+        pending += text
+        while '\n' in pending:
+            line, pending = pending.split('\n', 1)
+            line = line.rstrip('\r')
+            if line.startswith('data:'):
+                data_lines.append(line[6:] if line.startswith('data: ') else line[5:])
+            elif not line and data_lines:
+                # A blank line ends the event
+                data = '\n'.join(data_lines)
+                data_lines = []
+                if data != '[DONE]':
+                    parts.append(extract_html(data))
+                    add_live_finding(title, parts[-1])
+    if event_stream:
+        return '<html><body>\n' + '\n'.join(parts) + '\n</body></html>'
+    return ''.join(parts)
 
-def get_git_info():
-    """Get Git repository information"""
+# Cached result of `git config --list`, shared by every configuration lookup
+_git_config_cache = None
+
+def read_git_config():
+    """Read all Git configuration values with a single git invocation (cached)"""
+    global _git_config_cache
+    if _git_config_cache is None:
+        config = {}
+        try:
+            result = subprocess.run(['git', 'config', '--list', '-z'],
+                                  capture_output=True, check=False)
+            for entry in result.stdout.decode('utf-8', errors='replace').split('\0'):
+                if entry:
+                    key, _, value = entry.partition('\n')
+                    config[key] = value
+        except OSError as e:
+            print(f"Error reading Git configuration: {e}")
+        _git_config_cache = config
+    return _git_config_cache
+
+def get_git_dir():
+    """Locate the .git directory without spawning git"""
+    git_dir = os.environ.get('GIT_DIR')
+    if git_dir:
+        return os.path.abspath(git_dir)
+    
+    # Hooks run from the top of the work tree, but walk up to be safe
+    current = os.getcwd()
+    while True:
+        candidate = os.path.join(current, '.git')
+        if os.path.isdir(candidate):
+            return candidate
+        if os.path.isfile(candidate):
+            # Worktrees and submodules use a "gitdir: <path>" pointer file
+            try:
+                with open(candidate, 'r', encoding='utf-8') as f:
+                    content = f.read().strip()
+                if content.startswith('gitdir:'):
+                    return os.path.normpath(os.path.join(current, content[len('gitdir:'):].strip()))
+            except OSError:
+                pass
+        parent = os.path.dirname(current)
+        if parent == current:
+            break
+        current = parent
+    
+    # Fallback: ask git
     try:
-        # Get staged files
-        result = subprocess.run(['git', 'diff', '--cached', '--name-only'], 
-                              capture_output=True, text=True, check=True)
-        staged_files = result.stdout.strip().split('\n') if result.stdout.strip() else []
-        
-        # Get diff content
-        result = subprocess.run(['git', 'diff', '--cached'], 
+        result = subprocess.run(['git', 'rev-parse', '--absolute-git-dir'],
                               capture_output=True, text=True, check=True)
-        diff_content = result.stdout
-        
-        # Get repo name
+        return result.stdout.strip()
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+def get_branch_name(git_dir=None):
+    """Get the current branch name by reading HEAD directly"""
+    git_dir = git_dir or get_git_dir()
+    try:
+        with open(os.path.join(git_dir, 'HEAD'), 'r', encoding='utf-8') as f:
+            head = f.read().strip()
+        if head.startswith('ref: '):
+            ref = head[len('ref: '):]
+            return ref[len('refs/heads/'):] if ref.startswith('refs/heads/') else ref
+        # Detached HEAD, same as `git rev-parse --abbrev-ref HEAD`
+        return 'HEAD'
+    except (OSError, TypeError):
+        result = subprocess.run(['git', 'rev-parse', '--abbrev-ref', 'HEAD'],
+                              capture_output=True, text=True, check=False)
+        return result.stdout.strip()
+
+def get_repo_name():
+    """Get the repository name from the origin URL or the working directory"""
+    remote_url = read_git_config().get('remote.origin.url', '').strip()
+    if remote_url:
+        return remote_url.split('/')[-1].replace('.git', '')
+    return os.path.basename(os.getcwd())
+
+def get_setting(name, default=None):
+    """Read a hook setting from GENIE_<NAME> or `git config genie.<name>`"""
+    env_name = 'GENIE_' + re.sub(r'(?<!^)(?=[A-Z])', '_', name).upper()
+    value = os.environ.get(env_name)
+    if value is None:
+        value = read_git_config().get(f'genie.{name.lower()}')
+    if value is None:
+        return default
+    
+    value = value.strip()
+    if isinstance(default, bool):
+        # A key without a value ("[genie] cache") means true in git's config syntax
+        return value.lower() in ('', '1', 'true', 'yes', 'on')
+    if isinstance(default, int):
+        # Accept git-style size suffixes: 512k, 64m, 1g
+        multiplier = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}.get(value[-1:].lower(), 1)
         try:
-            result = subprocess.run(['git', 'config', '--get', 'remote.origin.url'], 
-                                  capture_output=True, text=True, check=False)
-            if result.stdout:
-                repo_name = result.stdout.strip().split('/')[-1].replace('.git', '')
+            return int(value[:-1] if multiplier > 1 else value) * multiplier
+        except ValueError:
+            print(f"Warning: Ignoring invalid value for {env_name}/genie.{name}: {value}")
+            return default
+    return value
+
+def iter_diff_stream(stream, window):
+    """Incrementally parse `git diff -z --raw --patch` output into ('raw' | 'line' | 'more', value) items"""
+    import codecs
+    
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    buffer = b''
+    in_raw = True
+    at_line_start = True
+    record = None
+    paths_needed = 0
+    
+    while True:
+        chunk = stream.read(window)
+        buffer += chunk
+        
+        # Raw section: ":<old mode> <new mode> <old sha> <new sha> <status>\0<path>\0[<path>\0]"
+        while in_raw:
+            end = buffer.find(b'\0')
+            if end < 0:
+                break
+            token, buffer = buffer[:end], buffer[end + 1:]
+            if paths_needed:
+                path = token.decode('utf-8', errors='replace')
+                if paths_needed == 2 or not record['old_path']:
+                    record['old_path'] = path
+                record['path'] = path
+                paths_needed -= 1
+                if not paths_needed:
+                    yield 'raw', record
+            elif token.startswith(b':'):
+                meta = token[1:].decode('ascii', errors='replace').split()
+                meta += [''] * (5 - len(meta))
+                status = meta[4][:1] or 'M'
+                record = {
+                    'path': '',
+                    'old_path': '',
+                    'status': status,
+                    'old_mode': meta[0],
+                    'new_mode': meta[1],
+                    'old_blob': meta[2],
+                    'new_blob': meta[3],
+                    'header': '',
+                    'hunks': [],
+                }
+                paths_needed = 2 if status in ('R', 'C') else 1
             else:
-                repo_name = os.path.basename(os.getcwd())
-        except:
-            repo_name = os.path.basename(os.getcwd())
+                # Empty token: the raw section is over, the patch follows
+                in_raw = False
         
-        # Get branch name
-        result = subprocess.run(['git', 'rev-parse', '--abbrev-ref', 'HEAD'], 
-                              capture_output=True, text=True, check=True)
-        branch_name = result.stdout.strip()
+        # Patch section: complete lines, or the whole window if one line is longer than that
+        if not in_raw:
+            end = buffer.rfind(b'\n') + 1
+            if not end and (len(buffer) >= window or not chunk):
+                end = len(buffer)
+            if end:
+                text = decoder.decode(buffer[:end], final=not chunk)
+                buffer = buffer[end:]
+                for line in text.splitlines(keepends=True):
+                    yield ('line' if at_line_start else 'more'), line
+                    at_line_start = line.endswith('\n')
         
-        return staged_files, diff_content, repo_name, branch_name
+        if not chunk:
+            break
+
+# Built-in exclusions: files whose diffs are large and not worth a review
+DEFAULT_EXCLUDES = {
+    'lockfile': [
+        'package-lock.json', 'npm-shrinkwrap.json', 'yarn.lock', 'pnpm-lock.yaml', 'bun.lockb',
+        'poetry.lock', 'Pipfile.lock', 'pdm.lock', 'uv.lock', 'Cargo.lock', 'Gemfile.lock',
+        'composer.lock', 'go.sum', 'packages.lock.json', 'Podfile.lock', 'pubspec.lock', 'mix.lock',
+    ],
+    'minified': ['*.min.js', '*.min.css', '*.min.map', '*.js.map', '*.css.map'],
+    'vendored': ['node_modules/', 'bower_components/', 'vendor/', 'third_party/', '.yarn/'],
+    'generated': ['*_pb2.py', '*_pb2_grpc.py', '*.pb.go', '*.generated.*', '__snapshots__/'],
+}
+
+def compile_ignore_pattern(pattern):
+    """Translate one gitignore-style pattern into a regular expression"""
+    anchored = '/' in pattern.rstrip('/')
+    pattern = pattern.strip('/') if anchored else pattern.rstrip('/')
+    regex = ''
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith('**/', i):
+            regex += '(?:.*/)?'
+            i += 3
+        elif pattern.startswith('/**', i) and i + 3 == len(pattern):
+            regex += '/.*'
+            i += 3
+        elif pattern[i] == '*':
+            regex += '.*' if pattern.startswith('**', i) else '[^/]*'
+            i += 2 if pattern.startswith('**', i) else 1
+        elif pattern[i] == '?':
+            regex += '[^/]'
+            i += 1
+        elif pattern[i] == '[':
+            end = pattern.find(']', i + 1)
+            if end < 0:
+                regex += re.escape(pattern[i])
+                i += 1
+            else:
+                regex += '[' + pattern[i + 1:end].replace('!', '^', 1) + ']'
+                i = end + 1
+        elif pattern[i] == '\\' and i + 1 < len(pattern):
+            regex += re.escape(pattern[i + 1])
+            i += 2
+        else:
+            regex += re.escape(pattern[i])
+            i += 1
+    return re.compile(('' if anchored else '(?:.*/)?') + regex + '$')
+
+def load_exclusion_rules():
+    """Compile the built-in exclusions and .genieignore into (regex, negated, directory_only, reason) rules"""
+    rules = []
+    if get_setting('excludeDefaults', True):
+        for reason, patterns in DEFAULT_EXCLUDES.items():
+            for pattern in patterns:
+                rules.append((compile_ignore_pattern(pattern), False, pattern.endswith('/'), reason))
+    
+    # Hooks run from the top of the work tree
+    try:
+        with open('.genieignore', 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.rstrip('\n').rstrip('\r')
+                if not line.strip() or line.startswith('#'):
+                    continue
+                if not line.endswith('\\ '):
+                    line = line.rstrip()
+                negated = line.startswith('!')
+                if negated or line.startswith('\\!') or line.startswith('\\#'):
+                    line = line[1:]
+                rules.append((compile_ignore_pattern(line), negated, line.endswith('/'), '.genieignore'))
+    except OSError:
+        pass
+    return rules
+
+def match_exclusion(path, rules):
+    """Return the reason a path is excluded, or None"""
+    parts = path.split('/')
+    # A file inside an excluded directory cannot be re-included, as in gitignore
+    for depth in range(1, len(parts) + 1):
+        candidate = '/'.join(parts[:depth])
+        is_directory = depth < len(parts)
+        reason = None
+        for regex, negated, directory_only, rule_reason in rules:
+            if directory_only and not is_directory:
+                continue
+            if regex.match(candidate):
+                reason = None if negated else rule_reason
+        if reason:
+            return reason
+    return None
+
+def read_git_attributes(paths, attributes):
+    """Read {path: {attribute: value}} for many paths with one `git check-attr --stdin` call"""
+    if not paths:
+        return {}
+    try:
+        result = subprocess.run(['git', 'check-attr', '--stdin', '-z'] + attributes,
+                              input=''.join(f'{path}\0' for path in paths).encode('utf-8'),
+                              capture_output=True, check=True)
+    except (subprocess.CalledProcessError, OSError) as e:
+        print(f"Warning: Could not read Git attributes: {e}")
+        return {}
+    
+    found = {}
+    fields = result.stdout.decode('utf-8', errors='replace').split('\0')
+    for i in range(0, len(fields) - 2, 3):
+        path, attribute, value = fields[i:i + 3]
+        if value not in ('unspecified', 'unset', 'false'):
+            found.setdefault(path, {})[attribute] = value
+    return found
+
+def apply_exclusions(files):
+    """Mark lockfiles, generated and vendored files so their patches are not sent"""
+    if not files:
+        return
+    
+    exclusions = get_setting('exclusions', True)
+    attributes = {}
+    if get_setting('checkAttributes', True):
+        names = ['linguist-language'] + (['linguist-generated', 'linguist-vendored'] if exclusions else [])
+        attributes = read_git_attributes([record['path'] for record in files], names)
+    for record in files:
+        record['attributes'] = attributes.get(record['path'], {})
+    if not exclusions:
+        return
+    
+    rules = load_exclusion_rules()
+    for record in files:
+        if record['status'] == 'D':
+            continue
+        reason = match_exclusion(record['path'], rules)
+        for attribute in ('linguist-generated', 'linguist-vendored'):
+            if attribute in record['attributes']:
+                reason = attribute
+        if reason:
+            record.update(excluded=reason, added=0, removed=0)
+
+# Kinds of rule in .genieskip and ~/.genie/skip, cheapest data first
+SKIP_RULE_KINDS = ('env', 'branch', 'author', 'paths', 'maxLines')
+
+# Version of the compiled rules in skip-rules.json; caches of another version are rebuilt
+SKIP_RULE_FORMAT = 2
+
+def get_skip_rule_files():
+    """The user's and the repository's skip rule files"""
+    # Hooks run from the top of the work tree
+    return [get_genie_dir('skip'), os.path.abspath('.genieskip')]
+
+def compile_skip_rules(sources):
+    """Parse skip rule files into {kind: value} with each kind's globs joined into one regex"""
+    patterns = {}
+    for path in sources:
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                lines = f.read().splitlines()
+        except OSError:
+            continue
+        for number, line in enumerate(lines, 1):
+            kind, _, values = line.split('#', 1)[0].strip().partition(' ')
+            if not kind:
+                continue
+            if kind not in SKIP_RULE_KINDS or not values.split():
+                print(f"Warning: Ignoring invalid skip rule at {path}:{number}: {line.strip()}")
+                continue
+            patterns.setdefault(kind, []).extend(values.split())
+    
+    rules = {}
+    if patterns.get('env'):
+        rules['env'] = patterns['env']
+    for kind in ('branch', 'author'):
+        if patterns.get(kind):
+            rules[kind] = '|'.join('(?:' + re.escape(pattern).replace(r'\*', '.*').replace(r'\?', '.') + ')$'
+                                   for pattern in patterns[kind])
+    if patterns.get('paths'):
+        # Directories are matched with a trailing "/", so "docs/" does not match a file named docs
+        rules['paths'] = '|'.join(f'(?:{compile_ignore_pattern(pattern).pattern[:-1]}'
+                                  f'{"/" if pattern.endswith("/") else "/?"}$)' for pattern in patterns['paths'])
+    limits = [int(value) for value in patterns.get('maxLines', []) if value.isdigit()]
+    if limits:
+        rules['maxLines'] = min(limits)
+    return rules
+
+def load_skip_rules(git_dir):
+    """The compiled skip rules, cached in <git dir>/genie/skip-rules.json by the rule files' size and mtime"""
+    sources = get_skip_rule_files()
+    stamp = []
+    for path in sources:
+        try:
+            info = os.stat(path)
+            stamp.append([path, info.st_mtime_ns, info.st_size])
+        except OSError:
+            stamp.append([path, None, None])
+    if not any(size for _, _, size in stamp):
+        return {}
+    
+    cache_file = os.path.join(git_dir, 'genie', 'skip-rules.json') if git_dir else None
+    cached = read_json_file(cache_file) if cache_file else None
+    if cached and cached.get('stamp') == stamp and cached.get('format') == SKIP_RULE_FORMAT:
+        return cached['rules']
+    rules = compile_skip_rules(sources)
+    if cache_file:
+        try:
+            write_json_file(cache_file, {'format': SKIP_RULE_FORMAT, 'stamp': stamp, 'rules': rules})
+        except OSError:
+            pass
+    return rules
+
+def read_staged_line_counts():
+    """{path: changed lines} of the staged changes from one `git diff --cached --numstat`"""
+    result = subprocess.run(['git', 'diff', '--cached', '--numstat', '-z'], capture_output=True, check=True)
+    counts = {}
+    fields = result.stdout.decode('utf-8', errors='replace').split('\0')
+    i = 0
+    while i < len(fields) - 1:
+        added, deleted, path = fields[i].split('\t', 2)
+        if not path:
+            # A rename: the old and new paths follow as separate fields
+            path = fields[i + 2]
+            i += 2
+        counts[path] = sum(int(count) for count in (added, deleted) if count.isdigit())
+        i += 1
+    return counts
+
+def check_skip_rules(git_dir):
+    """Return why the review should be skipped, or None, reading the cheapest data first"""
+    if os.environ.get('GENIE_SKIP', '').strip().lower() not in ('', '0', 'false', 'no', 'off'):
+        return "GENIE_SKIP is set"
+    
+    rules = load_skip_rules(git_dir)
+    if not rules:
+        return None
+    for name in rules.get('env', []):
+        if os.environ.get(name, '').strip().lower() not in ('', '0', 'false', 'no', 'off'):
+            return f"{name} is set"
+    
+    if 'branch' in rules:
+        branch = get_branch_name(git_dir)
+        if re.match(rules['branch'], branch):
+            return f"branch {branch} matches a skip rule"
+    
+    if 'author' in rules:
+        # git commit exports the author it resolved (from --author or the config) to the hook
+        for author in (os.environ.get('GIT_AUTHOR_NAME', ''), os.environ.get('GIT_AUTHOR_EMAIL', '')):
+            if author and re.match(rules['author'], author):
+                return f"author {author} matches a skip rule"
+    
+    if 'paths' in rules or 'maxLines' in rules:
+        try:
+            counts = read_staged_line_counts()
+        except (subprocess.CalledProcessError, OSError, ValueError):
+            return None
+        def matches(path):
+            # A path matches when it or one of its directories (tried as "dir/") does, as in .genieignore
+            parts = path.split('/')
+            return bool(re.match(rules['paths'], path)) or any(
+                re.match(rules['paths'], '/'.join(parts[:depth]) + '/') for depth in range(1, len(parts)))
         
-    except subprocess.CalledProcessError as e:
-        print(f"Git command failed: {e}")
-        return [], "", "", ""
+        if counts and 'paths' in rules and all(matches(path) for path in counts):
+            return f"all {len(counts)} staged file(s) match skip rules"
+        if sum(counts.values()) > rules.get('maxLines', float('inf')):
+            return f"{sum(counts.values())} changed lines, more than the maxLines skip rule allows"
+    return None
+
+def iter_file_patch(record):
+    """Yield the patch text of one file record piece by piece (header, then each hunk)"""
+    if record.get('omitted'):
+        yield (f"diff --git a/{record['old_path']} b/{record['path']}\n"
+               f"# Genie: patch omitted ({record['omitted']})\n")
+        return
+    if record.get('excluded'):
+        yield (f"diff --git a/{record['old_path']} b/{record['path']}\n"
+               f"# Genie: excluded from review ({record['excluded']}, "
+               f"+{record['added']} -{record['removed']} lines)\n")
+        return
+    yield record['header']
+    yield from record['hunks']
+    if record.get('dropped_lines'):
+        yield (f"# Genie: patch truncated at the {get_setting('maxFileBytes', 256 * 1024)} byte per-file budget, "
+               f"{record['dropped_lines']} more lines not sent\n")
+
+def format_file_patch(record):
+    """Return the patch text for one file record"""
+    return ''.join(iter_file_patch(record))
+
+def exclude_record(record, reason):
+    """Turn a partly collected record into an excluded stub, returning the bytes released"""
+    released = sum(len(hunk.encode('utf-8')) for hunk in record['hunks'])
+    added = removed = 0
+    for hunk in record['hunks']:
+        for line in hunk.splitlines()[1:]:
+            added += line.startswith('+')
+            removed += line.startswith('-')
+    # Keep one placeholder hunk so the remaining lines are still counted
+    record.update(excluded=reason, added=added, removed=removed, hunks=[''])
+    return released
+
+def describe_skipped_files(files):
+    """List the files that were not (fully) reviewed, and why, as an HTML report section"""
+    import html
+    
+    items = []
+    for record in files:
+        if record.get('omitted'):
+            reason = record['omitted']
+        elif record.get('excluded'):
+            reason = f"{record['excluded']}, +{record['added']} -{record['removed']} lines not sent"
+        elif record.get('binary'):
+            reason = 'binary file'
+        elif record.get('dropped_lines'):
+            reason = f"truncated at the per-file byte budget, {record['dropped_lines']} lines not sent"
+        else:
+            continue
+        items.append(f"<li><code>{html.escape(record['path'])}</code>: {html.escape(reason)}</li>")
+    if not items:
+        return None
+    return ('<html><body><p>These staged files were skipped or only partly sent for review:</p>\n<ul>\n'
+            + '\n'.join(items) + '\n</ul></body></html>')
+
+def dedupe_hunks(files):
+    """Send identical hunks only once; returns {(path, hunk index): [(path, line), ...]} for the kept copies"""
+    import hashlib
+    
+    if not get_setting('dedupeHunks', True):
+        return {}
+    
+    first_copies = {}
+    copies = {}
+    for record in files:
+        if record.get('excluded') or record.get('omitted'):
+            continue
+        for index, hunk in enumerate(record['hunks']):
+            if not hunk:
+                continue
+            header, _, body = hunk.partition('\n')
+            changed = [line.rstrip() for line in body.splitlines() if line[:1] in ('+', '-')]
+            if not changed:
+                continue
+            fingerprint = hashlib.sha1('\n'.join(changed).encode('utf-8')).digest()
+            location = (record['path'], parse_hunk_range(header)[2])
+            if fingerprint not in first_copies:
+                first_copies[fingerprint] = (record, index, location)
+                continue
+            original, original_index, original_location = first_copies[fingerprint]
+            copies.setdefault((original['path'], original_index), [original_location]).append(location)
+            record['hunks'][index] = (f"{header}\n# Genie: same change as {original_location[0]} line "
+                                      f"{original_location[1]}, sent once there\n")
+    
+    for record, index, _ in first_copies.values():
+        locations = copies.get((record['path'], index))
+        if locations:
+            listed = ', '.join(f'{path}:{line}' for path, line in locations[1:21])
+            more = f' and {len(locations) - 21} more' if len(locations) > 21 else ''
+            record['hunks'][index] += (f"# Genie: the same change also applies to {len(locations) - 1} "
+                                       f"other location(s): {listed}{more}\n")
+    return copies
+
+def describe_repeated_hunks(copies):
+    """Fan the findings of deduplicated hunks out to every location, as an HTML report section"""
+    import html
+    
+    if not copies:
+        return None
+    items = []
+    for locations in copies.values():
+        original = f'{locations[0][0]} line {locations[0][1]}'
+        others = ', '.join(f'{path} line {line}' for path, line in locations[1:])
+        items.append(f"<li>Findings for <code>{html.escape(original)}</code> also apply to "
+                     f"{html.escape(others)}</li>")
+    return ('<html><body><p>These identical changes were reviewed once:</p>\n<ul>\n'
+            + '\n'.join(items) + '\n</ul></body></html>')
+
+# State files git leaves in the git dir while a commit with a second parent or source is in progress
+PENDING_OPERATIONS = (('MERGE_HEAD', 'merge'), ('CHERRY_PICK_HEAD', 'cherry-pick'), ('REVERT_HEAD', 'revert'))
+
+def get_review_base(git_dir=None):
+    """Return (operation, tree) for the merge, cherry-pick or revert being concluded, tree being git's own result"""
+    git_dir = git_dir or get_git_dir()
+    for name, operation in PENDING_OPERATIONS:
+        try:
+            with open(os.path.join(git_dir, name), encoding='utf-8') as f:
+                heads = f.read().split()
+        except OSError:
+            continue
+        if not heads or get_setting('fullMergeReview', False):
+            return operation, None
+        if len(heads) > 1:
+            print("Warning: Octopus merge, reviewing the full diff")
+            return operation, None
+        
+        source = heads[0]
+        if operation == 'merge':
+            args = ['HEAD', source]
+        elif operation == 'cherry-pick':
+            args = [f'--merge-base={source}^', 'HEAD', source]
+        else:
+            args = [f'--merge-base={source}', 'HEAD', f'{source}^']
+        try:
+            # Exit status 1 only reports conflicts; the tree is still written
+            result = subprocess.run(['git', 'merge-tree', '--write-tree'] + args,
+                                  capture_output=True, text=True, check=False)
+            tree = result.stdout.split('\n', 1)[0].strip()
+            if result.returncode in (0, 1) and re.fullmatch(r'[0-9a-f]{40,64}', tree):
+                return operation, tree
+            error = (result.stderr.strip().splitlines() or ['no output'])[0]
+        except OSError as e:
+            error = e
+        # --write-tree needs git 2.38, --merge-base 2.40
+        print(f"Warning: Could not compute the automatic {operation} result ({error}), reviewing the full diff")
+        return operation, None
+    return None, None
+
+def collect_staged_changes(base=None):
+    """Collect staged files, status, patch, branch and repo name in a single bounded pass"""
+    window = max(get_setting('streamWindowBytes', 64 * 1024), 4096)
+    max_bytes = get_setting('maxDiffBytes', 32 * 1024 * 1024)
+    max_file_bytes = get_setting('maxFileBytes', 256 * 1024)
+    max_line_length = get_setting('maxLineLength', 1000)
+    
+    process = subprocess.Popen(['git', 'diff', '--cached', '-z', '--raw', '--patch', '--no-abbrev',
+                                '--no-color', '--no-ext-diff'] + ([base] if base else []),
+                               stdout=subprocess.PIPE)
+    files = []
+    retained = 0
+    truncated = False
+    current = None
+    next_index = 0
+    lines = []
+    classified = False
+    file_bytes = 0
+    line_length = 0
+    
+    def flush():
+        # Move the buffered lines into the current header or hunk
+        if current is not None and lines:
+            if current['hunks']:
+                current['hunks'][-1] += ''.join(lines)
+            else:
+                current['header'] += ''.join(lines)
+            lines.clear()
+    
+    try:
+        for kind, value in iter_diff_stream(process.stdout, window):
+            if kind == 'raw':
+                files.append(value)
+                continue
+            
+            # The raw section lists every file before the first patch line
+            if not classified:
+                apply_exclusions(files)
+                classified = True
+            
+            if kind == 'line' and (value.startswith('diff --git ') or value.startswith('@@')):
+                flush()
+                # A type change (e.g. file -> symlink) repeats the same header for its second half
+                if value.startswith('diff --git ') and not (
+                        current is not None and current['header'].startswith(value)):
+                    current = files[next_index] if next_index < len(files) else None
+                    next_index += 1
+                    file_bytes = 0
+                elif current is not None:
+                    current['hunks'].append('')
+            
+            line_length = line_length + len(value) if kind == 'more' else len(value)
+            if current is not None and current['hunks'] and not current.get('excluded'):
+                if line_length > max_line_length:
+                    # Minified or generated content: not worth a review
+                    flush()
+                    retained -= exclude_record(current, f"minified, a line of more than {max_line_length} characters")
+                elif file_bytes > max_file_bytes:
+                    current['dropped_lines'] = current.get('dropped_lines', 0) + (kind == 'line')
+                    continue
+            
+            if current is not None and current.get('excluded') and current['hunks']:
+                if kind == 'line' and value[:1] in ('+', '-'):
+                    current['added' if value[0] == '+' else 'removed'] += 1
+                continue
+            
+            lines.append(value)
+            size = len(value.encode('utf-8'))
+            retained += size
+            file_bytes += size
+            if retained > max_bytes:
+                truncated = True
+                break
+        flush()
+        if not classified:
+            apply_exclusions(files)
+    finally:
+        if truncated:
+            process.kill()
+        process.stdout.close()
+        returncode = process.wait()
+    
+    for record in files:
+        if not record['hunks'] and ('\nBinary files ' in record['header'] or 'GIT binary patch' in record['header']):
+            record['binary'] = True
+        record['language'] = detect_file_language(record)
+    
+    if truncated:
+        reason = f"staged diff exceeds the {max_bytes} byte limit"
+        for record in files[max(next_index - 1, 0):]:
+            record['header'], record['hunks'], record['omitted'] = '', [], reason
+    elif returncode != 0:
+        raise subprocess.CalledProcessError(returncode, process.args)
+    
+    return {
+        'files': files,
+        'truncated': truncated,
+        'repo_name': get_repo_name(),
+        'branch_name': get_branch_name(),
+        'base': base,
+    }
 
 def get_jwt_token():
     """Get JWT token from stored location"""
     try:
-        if platform.system() == "Windows":
+        if os.name == 'nt':
             token_file = os.path.join(os.path.expanduser("~"), ".genie", "token")
         else:
             token_file = os.path.expanduser("~/.genie/token")
@@ -191,49 +987,677 @@ def get_jwt_token():
     
     return None
 
-def send_for_review(diff_content, language, repo_name, branch_name, api_url, jwt_token):
-    """Send code changes for review with retry logic"""
-    import time
+def get_genie_dir(*parts):
+    """Get a path inside the per-user .genie directory"""
+    if os.name == 'nt':
+        genie_dir = os.path.join(os.path.expanduser("~"), ".genie")
+    else:
+        genie_dir = os.path.expanduser("~/.genie")
+    return os.path.join(genie_dir, *parts)
+
+def read_json_file(path, default=None):
+    """Load a JSON state file, returning default if it is missing or corrupt"""
+    import json
+    
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+def write_json_file(path, data):
+    """Atomically replace a JSON state file"""
+    import json
+    
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_file = f'{path}.{os.getpid()}.tmp'
+    with open(temp_file, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    os.replace(temp_file, path)
+
+def review_cache_key(records, language, repo_name, branch_name, api_url):
+    """Hash the request parameters, normalized patches and staged blob SHAs of a group of files"""
+    import hashlib
+    
+    digest = hashlib.sha256(f"{api_url}\0{repo_name}\0{branch_name}\0{language}\0".encode('utf-8'))
+    for record in records:
+        # The blob SHA is what `git ls-files -s` reports for the staged file
+        digest.update(f"{record['path']}\0{record['new_mode']}\0{record['new_blob']}\0".encode('utf-8'))
+        for piece in iter_file_patch(record):
+            for line in piece.splitlines():
+                # "index" lines only repeat the abbreviated blob SHAs; line endings are normalized
+                if not line.startswith('index '):
+                    digest.update(line.rstrip('\r').encode('utf-8') + b'\n')
+    return digest.hexdigest()
+
+def load_cached_review(key):
+    """Return the cached review response for key, or None on a miss"""
+    if not get_setting('cache', True):
+        return None
+    
+    cache_file = get_genie_dir('cache', 'reviews', f'{key}.response')
+    try:
+        created = os.path.getmtime(cache_file)
+        if time.time() - created > get_setting('cacheMaxAgeDays', 14) * 86400:
+            os.remove(cache_file)
+            return None
+        with open(cache_file, 'r', encoding='utf-8') as f:
+            response = f.read()
+        # Record the hit in atime for LRU eviction; mtime stays the creation time
+        os.utime(cache_file, (time.time(), created))
+        return response
+    except OSError:
+        return None
+
+def store_cached_review(key, response):
+    """Store a review response and evict old entries beyond the size and age limits"""
+    if not get_setting('cache', True):
+        return
+    
+    cache_dir = get_genie_dir('cache', 'reviews')
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        temp_file = os.path.join(cache_dir, f'{key}.{os.getpid()}.tmp')
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            f.write(response)
+        os.replace(temp_file, os.path.join(cache_dir, f'{key}.response'))
+        evict_review_cache(cache_dir)
+    except OSError as e:
+        print(f"Warning: Could not write review cache: {e}")
+
+def evict_review_cache(cache_dir):
+    """Drop expired entries, then least recently used ones until the cache fits its size limit"""
+    max_age = get_setting('cacheMaxAgeDays', 14) * 86400
+    max_bytes = get_setting('cacheMaxBytes', 64 * 1024 * 1024)
+    now = time.time()
+    
+    # Concurrent review threads (and other hook runs) evict at the same time,
+    # so an entry may already be gone by the time it is looked at
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if not entry.name.endswith('.response'):
+            continue
+        try:
+            stat = entry.stat()
+            if now - stat.st_mtime > max_age:
+                os.remove(entry.path)
+            else:
+                entries.append((stat.st_atime, stat.st_size, entry.path))
+        except FileNotFoundError:
+            pass
+    
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+def is_error_response(response):
+    """Check whether a review response is an API error rather than a report"""
+    return '"detail":' in response and ('"Unauthorized"' in response or '"Invalid token"' in response
+                                        or '"Not Found"' in response)
+
+def build_request_body(code_chunks, payload):
+    """Serialize the review payload into a spooled file, escaping the code one chunk at a time"""
+    import json
+    import tempfile
+    
+    body = tempfile.SpooledTemporaryFile(max_size=max(get_setting('streamWindowBytes', 64 * 1024), 4096))
+    body.write(b'{"code": "')
+    for chunk in code_chunks:
+        body.write(json.dumps(chunk)[1:-1].encode('utf-8'))
+    body.write(b'", ' + json.dumps(payload)[1:].encode('utf-8'))
+    length = body.tell()
+    body.seek(0)
+    return body, length
+
+# Serialises the read-modify-write updates of ~/.genie/backend.json between review threads
+_backend_lock = threading.Lock()
+
+def use_request_compression(api_url, length):
+    """Decide whether to gzip a request body of the given length (genie.compress)"""
+    mode = get_setting('compress', 'never').lower()
+    if mode in ('never', 'false', 'off', '0', ''):
+        return False
+    if mode in ('always', 'true', 'on', '1'):
+        return True
+    if length < get_setting('compressMinBytes', 1024):
+        return False
+    
+    with _backend_lock:
+        support = read_json_file(get_genie_dir('backend.json'), {}).get(api_url, {})
+    if support.get('gzip') is False and time.time() - support.get('checked', 0) < 7 * 86400:
+        return False
+    return True
+
+def remember_compression_support(api_url, supported):
+    """Persist whether the backend accepts gzip request bodies"""
+    backend_file = get_genie_dir('backend.json')
+    with _backend_lock:
+        backends = read_json_file(backend_file, {})
+        backends.setdefault(api_url, {}).update({'gzip': supported, 'checked': time.time()})
+        try:
+            write_json_file(backend_file, backends)
+        except OSError:
+            pass
+
+def gzip_request_body(body):
+    """Compress a spooled request body into another spooled file"""
+    import gzip
+    import shutil
+    import tempfile
+    
+    window = max(get_setting('streamWindowBytes', 64 * 1024), 4096)
+    compressed = tempfile.SpooledTemporaryFile(max_size=window)
+    body.seek(0)
+    with gzip.GzipFile(fileobj=compressed, mode='wb', compresslevel=6, mtime=0) as gz:
+        shutil.copyfileobj(body, gz, window)
+    length = compressed.tell()
+    compressed.seek(0)
+    return compressed, length
+
+def decode_response_body(raw, headers):
+    """Decode a response body, undoing gzip/deflate Content-Encoding"""
+    import zlib
+    import gzip
+    
+    encoding = (headers.get('Content-Encoding') or '').strip().lower()
+    if encoding in ('gzip', 'x-gzip'):
+        raw = gzip.decompress(raw)
+    elif encoding == 'deflate':
+        raw = zlib.decompress(raw)
+    return raw.decode('utf-8')
+
+def open_review_request(url, body, length, jwt_token, compressed, timeout=90, idempotency_key=None):
+    """POST a spooled JSON body, directly or through the agent, and return the open response"""
+    import urllib.request
+    
+    body.seek(0)
+    req = urllib.request.Request(url, data=body, method='POST')
+    
+    # Set headers
+    req.add_header('Content-Type', 'application/json')
+    req.add_header('Content-Length', str(length))
+    req.add_header('Accept-Encoding', 'gzip')
+    if compressed:
+        req.add_header('Content-Encoding', 'gzip')
+    req.add_header('Authorization', f'Bearer {jwt_token}')
+    if idempotency_key:
+        req.add_header('Idempotency-Key', idempotency_key)
+    if get_setting('streamReport', False):
+        req.add_header('Accept', 'text/event-stream, text/html;q=0.9, application/json;q=0.8')
+    
+    if use_agent(url):
+        try:
+            return open_agent_request(url, body, length, dict(req.header_items()), timeout)
+        except (FileNotFoundError, ConnectionRefusedError):
+            # Not running (or a stale socket): start it for the next commit and go direct
+            start_agent()
+            body.seek(0)
+    
+    return urllib.request.urlopen(req, timeout=timeout)
+
+_agent_started = threading.Event()
+
+def use_agent(url):
+    """Whether review requests go through the per-user background agent"""
+    import socket
+    import urllib.request
+    
+    # The agent's connections do not go through proxies
+    return (get_setting('agent', False) and hasattr(socket, 'AF_UNIX')
+            and not urllib.request.getproxies())
+
+def open_agent_request(url, body, length, headers, timeout=90):
+    """Send a review request through the agent's Unix socket and return a response like urlopen"""
+    import json
+    import socket
+    import io
+    import shutil
+    import email.message
+    import urllib.error
+    import urllib.response
+    
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout + 5)
+        sock.connect(get_genie_dir('agent.sock'))
+        with sock.makefile('rwb') as stream:
+            stream.write(json.dumps({'url': url, 'headers': headers, 'length': length,
+                                     'timeout': timeout}).encode('utf-8') + b'\n')
+            shutil.copyfileobj(body, stream)
+            stream.flush()
+            meta = json.loads(stream.readline() or b'{"error": "agent closed the connection"}')
+            data = stream.read(meta.get('length', 0))
+    finally:
+        sock.close()
+    
+    if 'error' in meta:
+        if meta.get('timeout'):
+            raise TimeoutError(f"agent: {meta['error']}")
+        raise urllib.error.URLError(f"agent: {meta['error']}")
+    response_headers = email.message.Message()
+    for name, value in meta['headers']:
+        response_headers[name] = value
+    if not 200 <= meta['status'] < 300:
+        raise urllib.error.HTTPError(url, meta['status'], meta['reason'], response_headers, io.BytesIO(data))
+    return urllib.response.addinfourl(io.BytesIO(data), response_headers, url, meta['status'])
+
+def get_hook_command(*args):
+    """Command line that runs this hook again, from the loose script or the installed bundle"""
+    script = os.path.abspath(__file__)
+    if os.path.isfile(os.path.dirname(script)):
+        # Loaded from <hooks dir>/genie-hooks.pyz/pre_commit.pyc
+        return [sys.executable, os.path.dirname(script), 'pre-commit', *args]
+    return [sys.executable, script, *args]
+
+# Variables git sets for this commit only; a detached helper outlives them
+COMMIT_GIT_ENV = ('GIT_INDEX_FILE', 'GIT_DIR', 'GIT_WORK_TREE', 'GIT_PREFIX')
+
+def get_detached_env():
+    """Environment for a detached helper, without the variables git set for this commit"""
+    return {name: value for name, value in os.environ.items() if name not in COMMIT_GIT_ENV}
+
+def start_agent():
+    """Start the background agent, detached, at most once per hook run"""
+    if _agent_started.is_set():
+        return
+    _agent_started.set()
+    try:
+        subprocess.Popen(get_hook_command('--agent'), env=get_detached_env(),
+                         cwd=os.path.expanduser('~'), start_new_session=True, stdin=subprocess.DEVNULL,
+                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        print("DEBUG: Started the review agent")
+    except OSError as e:
+        print(f"Warning: Could not start the review agent: {e}")
+
+def forward_agent_request(pool, pool_lock, meta, body):
+    """POST one request over a pooled keep-alive connection and return (status, reason, headers, data)"""
+    import http.client
+    import urllib.parse
+    
+    parts = urllib.parse.urlsplit(meta['url'])
+    key = (parts.scheme, parts.netloc)
+    path = parts.path + (f'?{parts.query}' if parts.query else '')
+    while True:
+        with pool_lock:
+            idle = pool.get(key)
+            connection = idle.pop() if idle else None
+        reused = connection is not None
+        if not reused:
+            connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+            connection = connection_class(parts.netloc)
+        # The client's (adaptive) timeout applies to this request only
+        connection.timeout = meta.get('timeout', 90)
+        if connection.sock:
+            connection.sock.settimeout(connection.timeout)
+        try:
+            connection.request('POST', path, body=body, headers=meta['headers'])
+            response = connection.getresponse()
+            data = response.read()
+        except (http.client.HTTPException, OSError):
+            connection.close()
+            if reused:
+                # The server closed the idle connection; try the next one
+                continue
+            raise
+        if response.will_close:
+            connection.close()
+        else:
+            with pool_lock:
+                pool.setdefault(key, []).append(connection)
+        return response.status, response.reason, response.getheaders(), data
+
+def run_agent():
+    """Serve review requests on ~/.genie/agent.sock until idle for genie.agentIdleMinutes"""
+    import json
+    import socketserver
+    
+    import fcntl
+    import signal
+    
+    socket_path = get_genie_dir('agent.sock')
+    os.makedirs(os.path.dirname(socket_path), mode=0o700, exist_ok=True)
+    lock = open(get_genie_dir('agent.lock'), 'w')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        return 0  # another agent is running
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    
+    idle_seconds = get_setting('agentIdleMinutes', 30) * 60
+    pool = {}
+    pool_lock = threading.Lock()
+    last_used = [time.time()]
+    
+    def handle_connection(request, client_address, server):
+        last_used[0] = time.time()
+        with request.makefile('rwb') as stream:
+            try:
+                meta = json.loads(stream.readline())
+                body = stream.read(meta['length'])
+                status, reason, headers, data = forward_agent_request(pool, pool_lock, meta, body)
+                answer = {'status': status, 'reason': reason, 'headers': headers, 'length': len(data)}
+            except Exception as e:
+                answer, data = {'error': str(e) or type(e).__name__, 'timeout': isinstance(e, TimeoutError)}, b''
+            stream.write(json.dumps(answer).encode('utf-8') + b'\n' + data)
+        last_used[0] = time.time()
+    
+    old_umask = os.umask(0o077)
+    try:
+        server = socketserver.ThreadingUnixStreamServer(socket_path, handle_connection)
+    finally:
+        os.umask(old_umask)
+    server.daemon_threads = True
+    server.timeout = 30
+    # Let `kill` remove the socket as well
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        while time.time() - last_used[0] < idle_seconds:
+            server.handle_request()
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
+    return 0
+
+def update_backend_health(api_url, failure=None, latency=None):
+    """Record the outcome of one review request in ~/.genie/backend.json"""
+    backend_file = get_genie_dir('backend.json')
+    with _backend_lock:
+        backends = read_json_file(backend_file, {})
+        health = backends.setdefault(api_url, {}).setdefault('health', {})
+        if failure is None:
+            health['latencies'] = (health.get('latencies', []) + [round(latency, 3)])[-20:]
+            health.update(consecutive=0, opened=None, trips=0)
+        else:
+            health.setdefault('failures', {})[failure] = health.get('failures', {}).get(failure, 0) + 1
+            health['consecutive'] = health.get('consecutive', 0) + 1
+            if health['consecutive'] >= max(get_setting('breakerFailures', 3), 1) or health.get('opened'):
+                health['trips'] = min(health.get('trips', 0) + 1, 5)
+                health['opened'] = time.time()
+        try:
+            write_json_file(backend_file, backends)
+        except OSError:
+            pass
+
+def get_circuit_state(api_url):
+    """Return ("closed" | "half-open" | "open", seconds until the next trial, backend health)"""
+    health = read_json_file(get_genie_dir('backend.json'), {}).get(api_url, {}).get('health', {})
+    if not health.get('opened'):
+        return 'closed', 0, health
+    cooldown = get_setting('breakerCooldownSeconds', 60) * 2 ** (health.get('trips', 1) - 1)
+    remaining = health['opened'] + cooldown - time.time()
+    return ('open' if remaining > 0 else 'half-open'), max(remaining, 0), health
+
+def get_review_timeout(health):
+    """Request timeout from the observed latencies: twice the 95th percentile, between 30 s and genie.requestTimeout"""
+    limit = get_setting('requestTimeout', 90)
+    latencies = sorted(health.get('latencies', []))
+    if len(latencies) < 5:
+        return limit
+    p95 = latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)]
+    return min(max(2 * p95, 30), limit)
+
+def classify_failure(error):
+    """Failure class of a request error: "server" (5xx), "timeout" or "connect"; None for 4xx"""
+    import urllib.error
+    
+    if isinstance(error, urllib.error.HTTPError):
+        return 'server' if error.code >= 500 else None
+    reason = getattr(error, 'reason', error)
+    if isinstance(reason, TimeoutError) or 'timed out' in str(reason):
+        return 'timeout'
+    return 'connect'
+
+def use_review_jobs(api_url):
+    """Whether reviews are submitted as jobs and polled (genie.reviewJobs: never, auto or always)"""
+    mode = get_setting('reviewJobs', 'never').lower()
+    if mode in ('never', 'false', 'off', '0', ''):
+        return False
+    if mode in ('always', 'true', 'on', '1'):
+        return True
+    support = read_json_file(get_genie_dir('backend.json'), {}).get(api_url, {})
+    return not (support.get('jobs') is False and time.time() - support.get('jobs_checked', 0) < 7 * 86400)
+
+def remember_job_support(api_url, supported):
+    """Persist whether the backend has the job API"""
+    backend_file = get_genie_dir('backend.json')
+    with _backend_lock:
+        backends = read_json_file(backend_file, {})
+        backends.setdefault(api_url, {}).update({'jobs': supported, 'jobs_checked': time.time()})
+        try:
+            write_json_file(backend_file, backends)
+        except OSError:
+            pass
+
+def hash_request_body(body):
+    """SHA-256 of a spooled request body"""
+    import hashlib
+    
+    digest = hashlib.sha256()
+    body.seek(0)
+    for block in iter(lambda: body.read(64 * 1024), b''):
+        digest.update(block)
+    return digest.hexdigest()
+
+def read_job_response(response):
+    """Decode a job API response: {"job_id", "poll_after"} or {"status", "result", "error"}"""
+    import json
+    
+    return json.loads(decode_response_body(response.read(), response.headers) or '{}')
+
+def poll_review_job(api_url, job_id, jwt_token, wait):
+    """Long-poll a review job once, the server holds the request for up to `wait` seconds"""
+    import urllib.request
+    import urllib.parse
+    
+    url = f"{api_url}/review/jobs/{urllib.parse.quote(job_id)}?wait={wait}"
+    req = urllib.request.Request(url, method='GET')
+    req.add_header('Accept-Encoding', 'gzip')
+    req.add_header('Authorization', f'Bearer {jwt_token}')
+    with urllib.request.urlopen(req, timeout=wait + 15) as response:
+        return read_job_response(response)
+
+def prune_review_jobs(max_age=86400):
+    """Forget job IDs of reviews that were abandoned long ago"""
+    jobs_dir = get_genie_dir('jobs')
+    try:
+        names = os.listdir(jobs_dir)
+    except OSError:
+        return
+    for name in names:
+        try:
+            if time.time() - os.path.getmtime(os.path.join(jobs_dir, name)) > max_age:
+                os.remove(os.path.join(jobs_dir, name))
+        except OSError:
+            pass
+
+def run_review_job(api_url, body, length, jwt_token, compressed, idempotency_key):
+    """Submit the review as a job and poll it until it is done; returns (handled, response)"""
+    import json
+    import random
+    import urllib.error
+    
+    job_file = get_genie_dir('jobs', f'{idempotency_key}.json')
+    job = read_json_file(job_file, {})
+    
+    def forget_job():
+        try:
+            os.remove(job_file)
+        except OSError:
+            pass
+
+    deadline = time.time() + get_setting('jobTimeout', 600)
+    
+    if not job.get('job_id') or time.time() - job.get('submitted', 0) > 3600:
+        job = {}
+        prune_review_jobs()
+        for attempt in range(3):
+            try:
+                with open_review_request(f"{api_url}/review/jobs", body, length, jwt_token, compressed,
+                                         idempotency_key=idempotency_key) as response:
+                    answer = read_job_response(response)
+                break
+            except urllib.error.HTTPError as e:
+                if e.code in (404, 405):
+                    print("DEBUG: Backend has no review job API, sending a blocking request")
+                    remember_job_support(api_url, False)
+                    return False, None
+                if compressed and e.code in (400, 415, 422):
+                    # The blocking request handles (and remembers) the compression fallback
+                    return False, None
+                print(f"HTTP Error submitting the review job: {e.code} - {e.reason}")
+                if e.code < 500:
+                    return True, None
+                update_backend_health(api_url, 'server')
+            except (urllib.error.URLError, OSError) as e:
+                print(f"Network error submitting the review job (attempt {attempt + 1}): {e}")
+                update_backend_health(api_url, classify_failure(e))
+            if attempt < 2:
+                time.sleep(random.uniform(0, 2 ** (attempt + 1)))
+        else:
+            return True, None
+        
+        if 'job_id' not in answer:
+            # The server finished the review within the submit request
+            return True, answer.get('result')
+        job = {'job_id': answer['job_id'], 'submitted': time.time()}
+        os.makedirs(os.path.dirname(job_file), exist_ok=True)
+        write_json_file(job_file, job)
+        delay = answer.get('poll_after', 1)
+        print(f"DEBUG: Review job {job['job_id']} submitted")
+    else:
+        delay = 0
+        print(f"DEBUG: Resuming review job {job['job_id']}")
+    
+    errors = 0
+    while time.time() < deadline:
+        time.sleep(delay)
+        try:
+            answer = poll_review_job(api_url, job['job_id'], jwt_token, get_setting('jobPollWait', 20))
+            errors = 0
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                # Expired or lost on the server; the next run submits it again
+                print(f"Review job {job['job_id']} is no longer known to the server")
+                forget_job()
+                return True, None
+            print(f"HTTP Error polling the review job: {e.code} - {e.reason}")
+            errors += 1
+        except (urllib.error.URLError, OSError) as e:
+            # e.g. a proxy cutting the connection; polling again is cheap
+            print(f"Network error polling the review job: {e}")
+            errors += 1
+        else:
+            status = answer.get('status')
+            if status in ('done', 'failed'):
+                forget_job()
+                if status == 'failed':
+                    print(f"Review job failed: {answer.get('error')}")
+                    return True, None
+                update_backend_health(api_url, latency=time.time() - job['submitted'])
+                result = answer.get('result')
+                return True, result if isinstance(result, str) else json.dumps(result)
+        if errors >= 5:
+            break
+        # Backoff with jitter; long polls already wait on the server
+        delay = random.uniform(0.5, min(1.5 ** (errors + 1), 10)) if errors else answer.get('poll_after', 1)
+    
+    print(f"Gave up waiting for review job {job['job_id']}; the next commit resumes it")
+    return True, None
+
+def send_for_review(diff_content, language, repo_name, branch_name, api_url, jwt_token, files=None):
+    """Send code changes (one string or an iterable of patch chunks) for review with retry logic"""
+    import random
+    import urllib.error
     
     payload = {
-        "code": diff_content,
         "language": language,
         "project_name": repo_name,
         "branch_name": branch_name,
         "html": True
     }
+    if files:
+        payload["files"] = files
+    
+    # Fail fast while the backend is known to be down
+    circuit, remaining, health = get_circuit_state(api_url)
+    if circuit == 'open':
+        print(f"Backend unavailable after repeated failures, not retrying for another {remaining:.0f}s")
+        return None
+    # After the cooldown a single trial request decides whether the circuit closes
+    attempts = 1 if circuit == 'half-open' else 3
+    timeout = get_review_timeout(health)
     
     # Convert payload to JSON bytes
-    json_data = json.dumps(payload).encode('utf-8')
+    code_chunks = [diff_content] if isinstance(diff_content, str) else diff_content
+    json_data, json_length = build_request_body(code_chunks, payload)
     
     # Create request
     url = f"{api_url}/review/review"
     
+    # The same payload always gets the same key, however often it is retried or resent
+    idempotency_key = hash_request_body(json_data)
+    
+    # Compress the body unless the backend is known not to accept it
+    compressed = use_request_compression(api_url, json_length)
+    if compressed:
+        gzip_data, gzip_length = gzip_request_body(json_data)
+    
     print("DEBUG: Sending request to API...")
-    print(f"DEBUG: Payload size: {len(json_data)} bytes")
+    print(f"DEBUG: Payload size: {json_length} bytes" + (f" ({gzip_length} bytes gzipped)" if compressed else ""))
+    
+    if use_review_jobs(api_url):
+        body, length = (gzip_data, gzip_length) if compressed else (json_data, json_length)
+        handled, response = run_review_job(api_url, body, length, jwt_token, compressed, idempotency_key)
+        if handled:
+            return response
     
-    # Retry logic: try 3 times with increasing delays
-    for attempt in range(3):
+    def read_review_response(response):
+        if response.getcode() == 200:
+            content_type = response.headers.get('Content-Type') or ''
+            if 'text/event-stream' in content_type or (
+                    'text/html' in content_type and 'chunked' in (response.headers.get('Transfer-Encoding') or '')):
+                return read_streamed_review(response, ', '.join(f['path'] for f in files or []) or 'Review')
+            return decode_response_body(response.read(), response.headers)
+        print(f"API Error: {response.getcode()}")
+        return None
+    
+    for attempt in range(attempts):
+        started = time.monotonic()
         try:
-            req = urllib.request.Request(url, data=json_data, method='POST')
-            
-            # Set headers
-            req.add_header('Content-Type', 'application/json')
-            req.add_header('Authorization', f'Bearer {jwt_token}')
+            if compressed:
+                try:
+                    with open_review_request(url, gzip_data, gzip_length, jwt_token, True, timeout,
+                                             idempotency_key) as response:
+                        result = read_review_response(response)
+                        update_backend_health(api_url, latency=time.monotonic() - started)
+                        return result
+                except urllib.error.HTTPError as e:
+                    # 415 is the standard answer; frameworks that cannot parse the body send 400/422
+                    if e.code not in (400, 415, 422):
+                        raise
+                    # Older backend: remember it and resend uncompressed right away
+                    print("DEBUG: Server does not accept compressed requests, resending uncompressed")
+                    remember_compression_support(api_url, False)
+                    compressed = False
             
-            # Send request with longer timeout
-            with urllib.request.urlopen(req, timeout=90) as response:
-                if response.getcode() == 200:
-                    return response.read().decode('utf-8')
-                else:
-                    print(f"API Error: {response.getcode()}")
-                    return None
+            with open_review_request(url, json_data, json_length, jwt_token, False, timeout,
+                                     idempotency_key) as response:
+                result = read_review_response(response)
+                update_backend_health(api_url, latency=time.monotonic() - started)
+                return result
                 
         except urllib.error.HTTPError as e:
             print(f"HTTP Error (attempt {attempt + 1}): {e.code} - {e.reason}")
             if hasattr(e, 'read'):
                 try:
-                    error_body = e.read().decode('utf-8')
+                    error_body = decode_response_body(e.read(), e.headers)
                     print(f"Error details: {error_body}")
                 except:
                     pass
@@ -241,26 +1665,498 @@ def send_for_review(diff_content, language, repo_name, branch_name, api_url, jwt
             # Don't retry on authentication errors (4xx)
             if 400 <= e.code < 500:
                 return None
+            failure = 'server'
                 
         except (urllib.error.URLError, OSError) as e:
-            print(f"Network error (attempt {attempt + 1}): {e}")
+            failure = classify_failure(e)
+            print(f"Network error (attempt {attempt + 1}, {failure}): {e}")
             
         except Exception as e:
             print(f"Error sending for review (attempt {attempt + 1}): {e}")
+            failure = 'connect'
+        
+        update_backend_health(api_url, failure)
+        if get_circuit_state(api_url)[0] == 'open':
+            print("Backend unavailable, giving up until it has had time to recover")
+            break
+        # A timed-out review is the most expensive failure, so it is retried only once
+        if failure == 'timeout' and attempt >= 1:
+            break
         
-        # Wait before retrying (exponential backoff)
-        if attempt < 2:  # Don't wait after the last attempt
-            wait_time = (attempt + 1) * 2  # 2, 4 seconds
-            print(f"Retrying in {wait_time} seconds...")
+        # Exponential backoff with full jitter, so hooks of many users do not retry in lockstep
+        if attempt < attempts - 1:
+            wait_time = random.uniform(0, min(2 ** (attempt + 1), 8))
+            print(f"Retrying in {wait_time:.1f} seconds...")
             time.sleep(wait_time)
     
-    print("Failed to send request after 3 attempts")
+    print(f"Failed to send request after {attempt + 1} attempt(s)")
     return None
 
+def record_size(record):
+    """Approximate size of a file record's patch in characters"""
+    if record.get('omitted') or record.get('excluded'):
+        return 100
+    return len(record['header']) + sum(len(hunk) for hunk in record['hunks'])
+
+def group_files_for_review(files):
+    """Split the staged files into requests by directory and language, within the request limits"""
+    sizes = {id(record): record_size(record) for record in files}
+    max_request_bytes = get_setting('maxRequestBytes', 1024 * 1024)
+    
+    def add_to_group(group, record):
+        # A file that would take the request past its byte cap is sent as a stub
+        if group[0] + sizes[id(record)] > max_request_bytes:
+            record.update(header='', hunks=[], omitted=f'request byte budget of {max_request_bytes} bytes exceeded')
+            sizes[id(record)] = record_size(record)
+        group[0] += sizes[id(record)]
+        group[1].append(record)
+    
+    if not get_setting('splitReview', True) or len(files) <= 1:
+        group = [0, []]
+        for record in files:
+            add_to_group(group, record)
+        return [group[1]] if files else []
+    
+    max_requests = max(get_setting('maxRequests', 8), 1)
+    target = max(get_setting('requestBytes', 256 * 1024), 1, -(-sum(sizes.values()) // max_requests))
+    target = min(target, max_request_bytes)
+    
+    clusters = {}
+    for record in files:
+        key = (record.get('language', 'unknown'), os.path.dirname(record['path']))
+        clusters.setdefault(key, []).append(record)
+    
+    units = []
+    for records in clusters.values():
+        unit, unit_size = [], 0
+        for record in records:
+            if unit and unit_size + sizes[id(record)] > target:
+                units.append((unit_size, unit))
+                unit, unit_size = [], 0
+            unit.append(record)
+            unit_size += sizes[id(record)]
+        units.append((unit_size, unit))
+    
+    # First-fit decreasing
+    groups = []
+    for unit_size, unit in sorted(units, key=lambda item: item[0], reverse=True):
+        for group in groups:
+            if group[0] + unit_size <= target:
+                group[0] += unit_size
+                group[1].extend(unit)
+                break
+        else:
+            groups.append([unit_size, list(unit)])
+    
+    # Past the request cap, files move to the smallest request with room, or become stubs there
+    overflow = [record for _, records in groups[max_requests:] for record in records]
+    groups = groups[:max_requests]
+    for record in overflow:
+        add_to_group(min(groups, key=lambda item: item[0]), record)
+    
+    groups.sort(key=lambda item: item[0], reverse=True)
+    return [records for _, records in groups]
+
+def describe_file_sections(records):
+    """Per-file metadata for the request: path, status, language and the offset and length of its section"""
+    sections = []
+    offset = 0
+    for record in records:
+        length = sum(len(piece) for piece in iter_file_patch(record))
+        sections.append({
+            'path': record['path'],
+            'status': record['status'],
+            'language': record.get('language', 'unknown'),
+            'offset': offset,
+            'length': length,
+        })
+        offset += length
+    return sections
+
+def review_file_groups(groups, repo_name, branch_name, api_url, jwt_token):
+    """Review each group of files concurrently and return (paths, response) tuples in group order"""
+    import concurrent.futures
+    
+    def review_group(group):
+        paths = [record['path'] for record in group]
+        language = group_language(group)
+        
+        # Identical staged content was reviewed before (e.g. a retried commit)
+        cache_key = review_cache_key(group, language, repo_name, branch_name, api_url)
+        response = load_cached_review(cache_key)
+        if response is not None:
+            print(f"DEBUG: Using cached review for {', '.join(paths)}")
+            return paths, response
+        
+        chunks = (piece for record in group for piece in iter_file_patch(record))
+        response = send_for_review(chunks, language, repo_name, branch_name, api_url, jwt_token,
+                                   files=describe_file_sections(group))
+        if response and not is_error_response(response):
+            store_cached_review(cache_key, response)
+        return paths, response
+    
+    if len(groups) == 1:
+        return [review_group(groups[0])]
+    
+    workers = min(max(get_setting('reviewWorkers', 4), 1), len(groups))
+    print(f"DEBUG: Reviewing {len(groups)} file groups with {workers} concurrent requests...")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(review_group, groups))
+
+# All-zero object ID git uses for a missing side of a diff
+NULL_OID = '0' * 40
+
+def read_ref(git_dir, ref):
+    """Resolve a ref to a commit SHA from the ref files, without spawning git"""
+    # Linked worktrees keep branches in the common directory
+    common_dir = git_dir
+    try:
+        with open(os.path.join(git_dir, 'commondir'), 'r', encoding='utf-8') as f:
+            common_dir = os.path.normpath(os.path.join(git_dir, f.read().strip()))
+    except OSError:
+        pass
+    
+    for directory in (git_dir, common_dir):
+        try:
+            with open(os.path.join(directory, ref), 'r', encoding='utf-8') as f:
+                return f.read().strip()
+        except OSError:
+            pass
+    try:
+        with open(os.path.join(common_dir, 'packed-refs'), 'r', encoding='utf-8') as f:
+            for line in f:
+                sha, _, name = line.strip().partition(' ')
+                if name == ref:
+                    return sha
+    except OSError:
+        pass
+    return ''
+
+def get_head_commit(git_dir=None):
+    """Get the commit SHA of HEAD ('' before the first commit) without spawning git"""
+    git_dir = git_dir or get_git_dir()
+    try:
+        with open(os.path.join(git_dir, 'HEAD'), 'r', encoding='utf-8') as f:
+            head = f.read().strip()
+    except (OSError, TypeError):
+        return ''
+    if head.startswith('ref: '):
+        return read_ref(git_dir, head[len('ref: '):])
+    return head
+
+def is_amend():
+    """Best-effort check whether the running `git commit` is an --amend"""
+    if get_setting('amend', False):
+        return True
+    # Git runs the hook as a direct child, so its command line is the parent's (Linux only)
+    try:
+        with open(f'/proc/{os.getppid()}/cmdline', 'rb') as f:
+            return b'--amend' in f.read().split(b'\0')
+    except OSError:
+        return False
+
+def get_commit_parents(git_dir, head, amend):
+    """The parents the running commit will get, for post-commit.py to recognise it by"""
+    if amend:
+        # --amend keeps the parents of the commit it replaces
+        result = subprocess.run(['git', 'rev-list', '--parents', '-n', '1', head or 'HEAD'],
+                              capture_output=True, text=True, check=False)
+        return result.stdout.split()[1:]
+    parents = [head] if head else []
+    try:
+        with open(os.path.join(git_dir, 'MERGE_HEAD'), 'r', encoding='utf-8') as f:
+            parents += f.read().split()
+    except OSError:
+        pass
+    return parents
+
+def get_review_state_file(branch_name):
+    """Path of the file remembering the last review of a branch"""
+    import hashlib
+    
+    repo_id = hashlib.sha256(os.path.abspath(get_git_dir() or os.getcwd()).encode('utf-8')).hexdigest()[:16]
+    safe_branch = re.sub(r'[^A-Za-z0-9._-]', '_', branch_name)
+    return get_genie_dir('state', repo_id, f'{safe_branch}.json')
+
+def load_review_state(branch_name):
+    """Load the last review state of a branch, or None"""
+    return read_json_file(get_review_state_file(branch_name))
+
+def save_review_state(branch_name, state):
+    """Remember the reviewed blobs, hunk ranges and findings of a branch"""
+    try:
+        write_json_file(get_review_state_file(branch_name), state)
+    except OSError as e:
+        print(f"Warning: Could not save review state: {e}")
+
+def parse_hunk_range(hunk):
+    """Return (old_start, old_count, new_start, new_count) from a hunk's @@ line"""
+    match = re.match(r'@@+ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@', hunk)
+    if not match:
+        return 0, 0, 0, 0
+    old_start, old_count, new_start, new_count = match.groups()
+    return (int(old_start), int(old_count or 1), int(new_start), int(new_count or 1))
+
+def get_hunk_ranges(record):
+    """New-side line ranges [start, count, response] of a record's hunks, not yet linked to a response"""
+    return [list(parse_hunk_range(hunk)[2:]) + [None] for hunk in record['hunks'] if hunk]
+
+def collect_blob_delta(record, reviewed_blob):
+    """Diff the reviewed blob of a file against its staged blob"""
+    result = subprocess.run(['git', 'diff', '--no-color', '--no-ext-diff', reviewed_blob, record['new_blob']],
+                          capture_output=True, check=True)
+    patch = result.stdout.decode('utf-8', errors='replace')
+    start = patch.find('\n@@')
+    hunks = re.split(r'(?m)^(?=@@)', patch[start + 1:]) if start >= 0 else []
+    path = record['path']
+    return dict(record, header=f"diff --git a/{path} b/{path}\n--- a/{path}\n+++ b/{path}\n",
+                hunks=[hunk for hunk in hunks if hunk])
+
+def carry_over_ranges(earlier_ranges, delta):
+    """Keep the earlier reviewed ranges that the delta did not touch, moved to their new lines"""
+    delta_ranges = [parse_hunk_range(hunk) for hunk in delta['hunks']]
+    surviving = []
+    for start, count, ref in earlier_ranges:
+        end = start + max(count, 1)
+        if any(old_start < end and start < old_start + max(old_count, 1)
+               for old_start, old_count, _, _ in delta_ranges):
+            continue
+        shift = sum(new_count - old_count for old_start, old_count, _, new_count in delta_ranges
+                    if old_start < start)
+        surviving.append([start + shift, count, ref])
+    return surviving
+
+def review_changes(changes, repo_name, branch_name, api_url, jwt_token):
+    """Review the staged changes, sending only what changed since the branch's last review"""
+    records = changes['files']
+    # Hunks of a merge resolution are not relative to HEAD, so they cannot be carried over
+    if not get_setting('incrementalReview', True) or changes['truncated'] or changes.get('base'):
+        return review_file_groups(group_files_for_review(records), repo_name, branch_name, api_url, jwt_token)
+    
+    # A deferred review runs after the commit, so it uses the HEAD and amend flag of its snapshot
+    head = changes['head'] if 'head' in changes else get_head_commit(get_git_dir())
+    amend = changes['amend'] if 'amend' in changes else is_amend()
+    state = load_review_state(branch_name) or {}
+    previous = {}
+    amending = False
+    if state.get('head') == head:
+        # Same commit retried, e.g. after an aborted commit or a fixup
+        previous = state.get('files', {})
+    elif state.get('files') and head and amend:
+        # Amending the last reviewed commit: its parent must be the reviewed HEAD
+        result = subprocess.run(['git', 'rev-parse', '-q', '--verify', f'{head}^'],
+                              capture_output=True, text=True, check=False)
+        if result.stdout.strip() == state.get('head'):
+            previous = state.get('files', {})
+            head = state['head']
+            amending = True
+    responses = state.get('responses', [])
+    
+    commit_paths = {record['path']: record for record in records}
+    if amending:
+        # Files of the amended commit that are not staged again stay part of the commit
+        for path in previous:
+            commit_paths.setdefault(path, None)
+    
+    to_review = []
+    files = {}
+    max_deltas = get_setting('incrementalMaxFiles', 20)
+    for path, record in commit_paths.items():
+        earlier = previous.get(path)
+        if earlier and (record is None or record['new_blob'] == earlier['blob']):
+            files[path] = earlier
+            continue
+        if (earlier and record['new_blob'] != NULL_OID and earlier['blob'] != NULL_OID and max_deltas > 0
+                and not record.get('excluded')):
+            try:
+                delta = collect_blob_delta(record, earlier['blob'])
+                max_deltas -= 1
+                files[path] = {'blob': record['new_blob'],
+                               'ranges': carry_over_ranges(earlier['ranges'], delta) + get_hunk_ranges(delta)}
+                to_review.append(delta)
+                continue
+            except (subprocess.CalledProcessError, OSError):
+                # The reviewed blob may have been garbage collected
+                pass
+        files[path] = {'blob': record['new_blob'], 'ranges': get_hunk_ranges(record)}
+        to_review.append(record)
+    
+    if previous:
+        print(f"DEBUG: Incremental review: {len(to_review)} file(s) changed, "
+              f"{len(files) - len(to_review)} unchanged since the last review")
+    
+    results = []
+    if to_review:
+        groups = group_files_for_review(to_review)
+        # Files sent as stubs were not reviewed, so they must not count as reviewed next time
+        for record in to_review:
+            if record.get('omitted'):
+                files.pop(record['path'], None)
+        results = review_file_groups(groups, repo_name, branch_name, api_url, jwt_token)
+    
+    # Earlier responses are shown once, titled with every file still referencing them
+    merged = list(results)
+    earlier_paths = {}
+    for path, entry in files.items():
+        for ref in dict.fromkeys(r[2] for r in entry['ranges'] if r[2] is not None):
+            earlier_paths.setdefault(ref, []).append(path)
+    for ref, paths in earlier_paths.items():
+        merged.append(([f'{", ".join(paths)} (earlier review)'], responses[ref]))
+    
+    if all(response and not is_error_response(response) for _, response in merged):
+        # Store each response once and point the reviewed hunks at it
+        reviewed = {path: response for paths, response in results for path in paths}
+        kept = {}
+        new_responses = []
+        for path, entry in files.items():
+            for hunk_range in entry['ranges']:
+                response = reviewed[path] if hunk_range[2] is None else responses[hunk_range[2]]
+                if response not in kept:
+                    kept[response] = len(new_responses)
+                    new_responses.append(response)
+                hunk_range[2] = kept[response]
+        save_review_state(branch_name, {'head': head, 'files': files, 'responses': new_responses})
+    
+    return merged
+
+# inotify event masks, from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+
+def open_inotify(directory):
+    """Watch a directory for written and renamed-in files; returns the inotify fd or None"""
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(os.O_CLOEXEC)
+        if fd < 0:
+            return None
+        if libc.inotify_add_watch(fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            os.close(fd)
+            return None
+        return fd
+    except (OSError, AttributeError):
+        return None
+
+def read_inotify_names(fd):
+    """Read the pending inotify events and return the file names they are about"""
+    import struct
+    
+    data = os.read(fd, 64 * 1024)
+    names = set()
+    offset = 0
+    while offset + 16 <= len(data):
+        # struct inotify_event { int wd; uint32_t mask, cookie, len; char name[]; }
+        _, _, _, length = struct.unpack_from('iIII', data, offset)
+        names.add(data[offset + 16:offset + 16 + length].rstrip(b'\0').decode('utf-8', errors='replace'))
+        offset += 16 + length
+    return names
+
+def iter_index_changes(git_dir, debounce, idle_seconds):
+    """Yield whenever the index has changed and then settled for `debounce` seconds"""
+    import select
+    
+    # git renames index.lock over the index (IN_MOVED_TO); without inotify its mtime and size are polled
+    fd = open_inotify(git_dir)
+    index_file = os.path.join(git_dir, 'index')
+    
+    def index_signature():
+        try:
+            info = os.stat(index_file)
+            return info.st_mtime_ns, info.st_size
+        except OSError:
+            return None
+    
+    signature = index_signature()
+    changed_at = None
+    last_change = time.time()
+    try:
+        while time.time() - last_change < idle_seconds:
+            timeout = debounce if changed_at else 1.0
+            if fd is not None:
+                ready, _, _ = select.select([fd], [], [], timeout)
+                changed = bool(ready) and 'index' in read_inotify_names(fd)
+            else:
+                time.sleep(timeout)
+                changed = index_signature() != signature
+                signature = index_signature()
+            if changed:
+                changed_at = last_change = time.time()
+            elif changed_at and time.time() - changed_at >= debounce:
+                changed_at = None
+                yield
+    finally:
+        if fd is not None:
+            os.close(fd)
+
+def speculative_review(api_url):
+    """Review the current staged changes so the pre-commit hook finds them cached"""
+    jwt_token = get_jwt_token()
+    if not jwt_token:
+        return
+    operation, base = get_review_base()
+    changes = collect_staged_changes(base)
+    if not any(record['header'] or record.get('omitted') for record in changes['files']):
+        return
+    dedupe_hunks(changes['files'])
+    print(f"Reviewing {len(changes['files'])} staged file(s) ahead of the commit")
+    results = review_changes(changes, changes['repo_name'], changes['branch_name'], api_url, jwt_token)
+    failed = sum(1 for _, response in results if not response or is_error_response(response))
+    print(f"Speculative review done, {failed} of {len(results)} request(s) failed")
+
+def run_index_watcher():
+    """Review the index speculatively whenever it settles (run detached with --watch)"""
+    import fcntl
+    
+    global _git_config_cache
+    
+    git_dir = get_git_dir()
+    os.makedirs(get_deferred_review_dir(git_dir), exist_ok=True)
+    lock = open(os.path.join(get_deferred_review_dir(git_dir), 'watch.lock'), 'w')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        return 0  # already watching this work tree
+    
+    debounce = max(get_setting('watchDebounceMs', 1500), 100) / 1000
+    for _ in iter_index_changes(git_dir, debounce, get_setting('watchIdleMinutes', 60) * 60):
+        # Pick up configuration changes made while watching
+        _git_config_cache = None
+        api_url = get_api_url()
+        if not api_url:
+            continue
+        try:
+            speculative_review(api_url)
+        except Exception as e:
+            print(f"Speculative review failed: {e}")
+        sys.stdout.flush()
+    return 0
+
+def start_index_watcher():
+    """Start the index watcher for this work tree unless it is already running"""
+    if os.name != 'posix':
+        return
+    import fcntl
+    
+    review_dir = get_deferred_review_dir()
+    try:
+        os.makedirs(review_dir, exist_ok=True)
+        with open(os.path.join(review_dir, 'watch.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        return  # running (or the git dir is read-only)
+    
+    with open(os.path.join(review_dir, 'watch.log'), 'w', encoding='utf-8') as log:
+        subprocess.Popen(get_hook_command('--watch'), env=get_detached_env(),
+                         stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+    print("DEBUG: Started the index watcher for speculative reviews")
+
 def get_api_url():
     """Get API URL from configuration file"""
     try:
-        if platform.system() == "Windows":
+        if os.name == 'nt':
             config_file = os.path.join(os.path.expanduser("~"), ".genie", "config")
         else:
             config_file = os.path.expanduser("~/.genie/config")
@@ -282,10 +2178,226 @@ def get_api_url():
         print(f"Error reading API configuration: {e}")
         return None
 
+def get_deferred_review_dir(git_dir=None):
+    """Directory in the git dir holding deferred review snapshots and worker logs"""
+    return os.path.join(git_dir or get_git_dir(), 'genie')
+
+def defer_review(changes, repeated, api_url):
+    """Snapshot the collected changes in <git dir>/genie/pending.json for post-commit.py to review"""
+    git_dir = get_git_dir()
+    head = get_head_commit(git_dir)
+    amend = is_amend()
+    changes = dict(changes, head=head, amend=amend, parents=get_commit_parents(git_dir, head, amend))
+    snapshot = {'created': time.time(), 'api_url': api_url, 'changes': changes, 'repeated': repeated}
+    try:
+        os.makedirs(get_deferred_review_dir(git_dir), exist_ok=True)
+        write_json_file(os.path.join(get_deferred_review_dir(git_dir), 'pending.json'), snapshot)
+    except OSError as e:
+        print(f"Warning: Could not save the deferred review ({e}), reviewing now")
+        return finish_review(changes, repeated, api_url, get_jwt_token())
+    print("DEBUG: Review deferred, it starts in the background once the commit is made")
+    return 0
+
+def review_deferred_commit(snapshot_file):
+    """Review a snapshot claimed by post-commit.py (run detached with --review-commit)"""
+    snapshot = read_json_file(snapshot_file)
+    if not snapshot:
+        print(f"ERROR: Could not read the deferred review {snapshot_file}")
+        return 1
+    commit = os.path.splitext(os.path.basename(snapshot_file))[0]
+    print(f"Reviewing commit {commit}")
+    
+    jwt_token = get_jwt_token()
+    if not jwt_token:
+        show_message_box("ERROR: Authentication token not found. Please run the Genie GitHooks app to login again.")
+        return 1
+    return finish_review(snapshot['changes'], snapshot.get('repeated'), snapshot['api_url'], jwt_token, commit)
+
+def spool_review(changes, repeated, api_url, commit=None):
+    """Queue a review that could not be sent in ~/.genie/spool/ and let the commit through"""
+    spool_dir = get_genie_dir('spool')
+    name = f"{int(time.time() * 1000)}-{os.urandom(4).hex()}.json"
+    entry = {'created': time.time(), 'api_url': api_url, 'commit': commit, 'changes': changes,
+             'repeated': repeated, 'attempts': 0}
+    try:
+        os.makedirs(spool_dir, exist_ok=True)
+        write_json_file(os.path.join(spool_dir, name), entry)
+        if commit is None:
+            os.makedirs(get_deferred_review_dir(), exist_ok=True)
+            with open(os.path.join(get_deferred_review_dir(), 'spooled'), 'w', encoding='utf-8') as f:
+                f.write(name)
+    except OSError as e:
+        show_message_box(f"ERROR: Unable to communicate with the server, and the review could not be queued: {e}")
+        return 1
+    
+    queued = sorted(queued_name for queued_name in os.listdir(spool_dir) if queued_name.endswith('.json'))
+    sizes = {queued_name: os.path.getsize(os.path.join(spool_dir, queued_name)) for queued_name in queued}
+    max_entries = max(get_setting('spoolMaxEntries', 20), 1)
+    max_bytes = get_setting('spoolMaxBytes', 16 * 1024 * 1024)
+    while len(queued) > 1 and (len(queued) > max_entries or sum(sizes[queued_name] for queued_name in queued) > max_bytes):
+        print(f"Warning: Review queue is full, dropping the oldest queued review ({queued[0]})")
+        os.remove(os.path.join(spool_dir, queued.pop(0)))
+    
+    print(f"WARNING: The review server is unreachable. The review was queued ({len(queued)} waiting) "
+          f"and runs once the server is back; the commit goes ahead.")
+    return 0
+
+def replay_spooled_review(entry_file):
+    """Review one queued entry; returns (entry, report path) on success, None otherwise"""
+    import html
+    
+    entry = read_json_file(entry_file)
+    if not entry:
+        return None
+    api_url = entry['api_url']
+    jwt_token = get_jwt_token()
+    if get_circuit_state(api_url)[0] == 'open' or not jwt_token:
+        return None
+    
+    changes = entry['changes']
+    results = review_file_groups(group_files_for_review(changes['files']), changes['repo_name'],
+                                 changes['branch_name'], api_url, jwt_token)
+    if not all(response and not is_error_response(response) for _, response in results):
+        entry['attempts'] = entry.get('attempts', 0) + 1
+        if entry['attempts'] >= 5:
+            print(f"Giving up on queued review {os.path.basename(entry_file)} after 5 attempts")
+            os.remove(entry_file)
+        else:
+            write_json_file(entry_file, entry)
+        return None
+    
+    add_report_sections(results, changes, entry.get('repeated'))
+    label = entry.get('commit') or os.path.splitext(os.path.basename(entry_file))[0]
+    queued = time.strftime('%Y-%m-%d %H:%M', time.localtime(entry['created']))
+    results.insert(0, ([f"Commit {label[:12]}"], f'<html><body><p>Review of commit <code>{html.escape(label)}</code> '
+                       f'on {html.escape(changes["branch_name"])} in {html.escape(changes["repo_name"])}, '
+                       f'queued on {queued} while the server was unreachable.</p></body></html>'))
+    report_file = get_genie_dir('reviews', f'{label}.html')
+    os.makedirs(os.path.dirname(report_file), exist_ok=True)
+    with open(report_file, 'w', encoding='utf-8') as f:
+        f.write(extract_html(merge_review_reports(results)))
+    os.remove(entry_file)
+    return entry, report_file
+
+# Reports kept in ~/.genie/reviews; the oldest are removed beyond this
+MAX_KEPT_REPORTS = 200
+
+def prune_kept_reports(max_reports=MAX_KEPT_REPORTS):
+    """Remove the oldest reports in ~/.genie/reviews beyond max_reports"""
+    reports = []
+    for entry in os.scandir(get_genie_dir('reviews')):
+        try:
+            if entry.name.endswith('.html'):
+                reports.append((entry.stat().st_mtime, entry.path))
+        except OSError:
+            pass
+    for _, path in sorted(reports)[:-max_reports]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def replay_spooled_reviews():
+    """Send the queued reviews in batches (run detached with --replay) and list them on one page"""
+    import html
+    import concurrent.futures
+    
+    spool_dir = get_genie_dir('spool')
+    lock_file = os.path.join(spool_dir, 'replay.lock')
+    try:
+        if time.time() - os.path.getmtime(lock_file) > 3600:
+            os.remove(lock_file)  # left behind by a replay that was killed
+    except OSError:
+        pass
+    try:
+        os.close(os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except OSError:
+        return 0  # another replay is running
+    
+    replayed = []
+    try:
+        batch_size = max(get_setting('replayBatch', 8), 1)
+        workers = max(get_setting('replayWorkers', 2), 1)
+        while True:
+            batch = sorted(name for name in os.listdir(spool_dir) if name.endswith('.json'))[:batch_size]
+            if not batch:
+                break
+            print(f"Replaying {len(batch)} queued review(s)...")
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                done = [result for result in executor.map(replay_spooled_review,
+                                                          (os.path.join(spool_dir, name) for name in batch)) if result]
+            replayed.extend(done)
+            if not done:
+                break
+    finally:
+        os.remove(lock_file)
+    
+    if replayed:
+        prune_kept_reports()
+        items = '\n'.join(f'<li><a href="file://{html.escape(path)}">{html.escape((entry.get("commit") or "uncommitted")[:12])}</a> '
+                          f'{html.escape(entry["changes"]["branch_name"])} in {html.escape(entry["changes"]["repo_name"])}</li>'
+                          for entry, path in replayed)
+        open_html_in_browser(f'<html><body><h1>Queued reviews</h1>\n<ul>\n{items}\n</ul></body></html>')
+    return 0
+
+def start_spool_replay():
+    """Replay queued reviews in a detached process when there are any"""
+    try:
+        if not any(name.endswith('.json') for name in os.listdir(get_genie_dir('spool'))):
+            return
+    except OSError:
+        return
+    options = {'start_new_session': True} if os.name == 'posix' else {
+        'creationflags': subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP}
+    subprocess.Popen(get_hook_command('--replay'), cwd=os.path.expanduser('~'), env=get_detached_env(),
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, **options)
+
+# How long each phase of this run took, in milliseconds (see end_phase)
+_phase_timings = {}
+
+def end_phase(name, started):
+    """Record the duration of a phase that began at `started`; returns the time it ended"""
+    ended = time.perf_counter()
+    _phase_timings[name] = round((ended - started) * 1000, 1)
+    return ended
+
+def record_review(changes, report_file):
+    """Leave the review's report and phase timings in <git dir>/genie/review.json for post-commit.py"""
+    git_dir = get_git_dir()
+    amend = is_amend()
+    record = {
+        'created': time.time(),
+        'parents': get_commit_parents(git_dir, get_head_commit(git_dir), amend),
+        'amend': amend,
+        'base': changes.get('base'),
+        'branch': changes['branch_name'],
+        'files': {file['path']: file['new_blob'] for file in changes['files']},
+        'report': report_file,
+        'timings': _phase_timings,
+    }
+    try:
+        write_json_file(os.path.join(get_deferred_review_dir(git_dir), 'review.json'), record)
+    except OSError as e:
+        print(f"Warning: Could not record the review for the post-commit hook: {e}")
+
 def main():
     """Main pre-commit hook logic"""
     print("pre-commit")
     
+    started = time.perf_counter()
+    git_dir = get_git_dir()
+    # Whatever an aborted commit left for post-commit.py must not be linked to this one
+    for name in ('pending.json', 'review.json'):
+        try:
+            os.remove(os.path.join(get_deferred_review_dir(git_dir), name))
+        except (OSError, TypeError):
+            pass
+    reason = check_skip_rules(git_dir)
+    if reason:
+        print(f"Skipping review: {reason}")
+        return 0
+    started = end_phase('rules', started)
+    
     # Get API URL from configuration file
     api_url = get_api_url()
     if not api_url:
@@ -295,48 +2407,70 @@ def main():
         return 1
     
     # Check Git configuration
-    try:
-        result = subprocess.run(['git', 'config', '--global', '--get', 'user.name'], 
-                              capture_output=True, text=True, check=False)
-        git_username = result.stdout.strip()
-        
-        result = subprocess.run(['git', 'config', '--global', '--get', 'user.email'], 
-                              capture_output=True, text=True, check=False)
-        git_email = result.stdout.strip()
-        
-        if not git_username or not git_email:
-            show_message_box('Error: Git global username and/or email is not set.\n'
-                           'Please configure them using:\n'
-                           'git config --global user.name "Your Name"\n'
-                           'git config --global user.email "you@example.com"')
-            return 1
-            
-    except Exception as e:
-        print(f"Error checking Git configuration: {e}")
+    git_config = read_git_config()
+    git_username = git_config.get('user.name', '').strip()
+    git_email = git_config.get('user.email', '').strip()
+    
+    if not git_username or not git_email:
+        show_message_box('Error: Git global username and/or email is not set.\n'
+                       'Please configure them using:\n'
+                       'git config --global user.name "Your Name"\n'
+                       'git config --global user.email "you@example.com"')
         return 1
     
+    if get_setting('speculativeReview', False):
+        start_index_watcher()
+    if get_setting('offlineSpool', False) and get_circuit_state(api_url)[0] != 'open':
+        start_spool_replay()
+    
     # Get Git information
-    staged_files, diff_content, repo_name, branch_name = get_git_info()
+    operation, base = get_review_base()
+    if base:
+        print(f"DEBUG: Concluding a {operation}, reviewing only the changes made by hand "
+              f"(set genie.fullMergeReview to review the full diff)")
+    try:
+        changes = collect_staged_changes(base)
+    except (subprocess.CalledProcessError, OSError) as e:
+        print(f"Git command failed: {e}")
+        return 1
+    
+    staged_files = [record['path'] for record in changes['files']]
     
+    if not staged_files and base:
+        print(f"No changes made by hand while resolving the {operation}, nothing to review.")
+        return 0
     if not staged_files:
         show_message_box("No files staged for commit.")
         return 0
     
-    if not diff_content:
+    if not any(record['header'] or record.get('omitted') for record in changes['files']):
         show_message_box("No changes detected in staged files.")
         return 0
     
-    # Detect programming language
-    language = detect_language(staged_files)
-    
-    # Debug output
-    # print(f"DEBUG: Staged files: {' '.join(staged_files)}")
-    # print(f"DEBUG: Language detected: {language}")
-    # print(f"DEBUG: Repo name: {repo_name}")
-    # print(f"DEBUG: Branch name: {branch_name}")
-    # print(f"DEBUG: Diff content length: {len(diff_content)}")
-    # print("DEBUG: First 200 chars of diff:")
-    print(diff_content[:200])
+    excluded = [f"{record['path']} ({record['excluded']})" for record in changes['files'] if record.get('excluded')]
+    if excluded:
+        print(f"DEBUG: {len(excluded)} file(s) excluded from review and sent as one-line stubs:")
+        for path in excluded[:20]:
+            print(f"  {path}")
+        if len(excluded) > 20:
+            print(f"  ... and {len(excluded) - 20} more")
+    
+    if changes['truncated']:
+        omitted = [record['path'] for record in changes['files'] if record.get('omitted')]
+        print("WARNING: The staged diff is larger than the configured limit (genie.maxDiffBytes).")
+        print(f"WARNING: {len(omitted)} file(s) will be sent as one-line stubs without their patch:")
+        for path in omitted[:20]:
+            print(f"  {path}")
+        if len(omitted) > 20:
+            print(f"  ... and {len(omitted) - 20} more")
+    
+    copies = dedupe_hunks(changes['files'])
+    if copies:
+        print(f"DEBUG: {sum(len(locations) - 1 for locations in copies.values())} repeated hunk(s) "
+              f"sent once, {len(copies)} unique")
+    end_phase('collect', started)
+    
+    print(format_file_patch(changes['files'][0])[:200])
     print("")
     print("--- End diff preview ---")
     
@@ -348,10 +2482,42 @@ def main():
     
     # API URL is already set from command line argument above
     
-    # Send for review
-    response = send_for_review(diff_content, language, repo_name, branch_name, api_url, jwt_token)
+    if get_setting('deferReview', False):
+        return defer_review(changes, describe_repeated_hunks(copies), api_url)
+    
+    return finish_review(changes, describe_repeated_hunks(copies), api_url, jwt_token)
+
+def add_report_sections(results, changes, repeated):
+    """Add the "Files not fully reviewed" and "Repeated changes" sections to the review results"""
+    # Say exactly what was not reviewed
+    skipped = describe_skipped_files(changes['files'])
+    if skipped and results:
+        results.insert(0, (['Files not fully reviewed'], skipped))
+    if repeated and results:
+        results.append((['Repeated changes'], repeated))
+
+def finish_review(changes, repeated, api_url, jwt_token, commit=None):
+    """Send the collected changes for review, open the merged report and return the exit code"""
+    global _live_report
+    if get_setting('streamReport', False):
+        _live_report = start_live_report()
+    
+    # Send for review, one request per group of files
+    started = time.perf_counter()
+    results = review_changes(changes, changes['repo_name'], changes['branch_name'], api_url, jwt_token)
+    started = end_phase('review', started)
+    
+    # Backend unreachable (not a rejected request): queue the review and let the commit through
+    if (not all(response for _, response in results) and get_setting('offlineSpool', False)
+            and get_circuit_state(api_url)[2].get('consecutive')):
+        return spool_review(changes, repeated, api_url, commit)
     
-    if response:
+    add_report_sections(results, changes, repeated)
+    
+    for paths, response in results:
+        if not response:
+            continue
+        
         # Check for authentication errors
         if '"detail":' in response and ('"Unauthorized"' in response or '"Invalid token"' in response):
             show_message_box("ERROR: Authentication failed. Your session may have expired.\n"
@@ -362,15 +2528,33 @@ def main():
         if '"detail":' in response and '"Not Found"' in response:
             show_message_box("ERROR: API endpoint not found. Please check server configuration.")
             return 1
-        
-        # Open HTML response in browser
-        open_html_in_browser(response)
-    else:
+    
+    report_file = None
+    if _live_report and _live_report['opened']:
+        # The browser already shows the live page; turn it into the final report
+        write_live_report(_live_report, extract_html(merge_review_reports(results)))
+        report_file = _live_report['path']
+    elif any(response for _, response in results):
+        # Open the merged HTML report in browser
+        report_file = open_html_in_browser(merge_review_reports(results))
+    end_phase('report', started)
+    
+    if not all(response for _, response in results):
         show_message_box("ERROR: Unable to communicate with the server. Check internet connection or server status.")
         return 1
     
+    if commit is None and get_setting('commitLog', False):
+        record_review(changes, report_file)
     return 0
 
 if __name__ == "__main__":
+    if sys.argv[1:2] == ['--agent']:
+        sys.exit(run_agent())
+    if sys.argv[1:2] == ['--replay']:
+        sys.exit(replay_spooled_reviews())
+    if sys.argv[1:2] == ['--watch']:
+        sys.exit(run_index_watcher())
+    if sys.argv[1:2] == ['--review-commit']:
+        sys.exit(review_deferred_commit(sys.argv[2]))
     exit_code = main()
     sys.exit(exit_code) 
\ No newline at end of file
@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+"""
+Genie GitHooks - Local stand-in backend
+Developer tool that serves the review API locally so the hook's transport
+can be exercised without a real backend:
+
+    python mock_backend.py serve --port 8765 --latency 2
+    python mock_backend.py check
+
+`serve` answers POST /review/review (blocking) and the job API
+(POST /review/jobs, GET /review/jobs/<id>?wait=N), and honours the
+Idempotency-Key header on both POSTs. With --stream, a blocking review
+that accepts text/event-stream is streamed one finding per event. `check`
+starts the server in-process and runs the hook's client against it.
+"""
+
+import os
+import sys
+import json
+import gzip
+import shlex
+import time
+import uuid
+import argparse
+import tempfile
+import threading
+import subprocess
+import webbrowser
+import http.server
+import urllib.parse
+
+from benchmark_hooks import load_hook
+
+class MockBackend(http.server.ThreadingHTTPServer):
+    """Review API stand-in that counts the reviews it performs"""
+
+    daemon_threads = True
+
+    def __init__(self, port, latency=0.0, jobs=True, drop_polls=0, stream=False):
+        super().__init__(('127.0.0.1', port), MockHandler)
+        self.latency = latency
+        self.stream = stream
+        self.jobs_enabled = jobs
+        self.drop_polls = drop_polls
+        self.reviews = 0
+        self.reviewed_files = []
+        self.submissions = 0
+        self.jobs = {}
+        self.keys = {}
+        self.lock = threading.Lock()
+
+    def handle_error(self, request, client_address):
+        # Clients that timed out have gone away; the scenarios expect that
+        if not isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            super().handle_error(request, client_address)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def review(self, payload):
+        """Do the (simulated) expensive work and return the response body"""
+        with self.lock:
+            self.reviews += 1
+            self.reviewed_files.append([f['path'] for f in payload.get('files', [])])
+        time.sleep(self.latency)
+        files = ', '.join(f['path'] for f in payload.get('files', [])) or 'diff'
+        return {"html": f"<html><body><h1>Review</h1><p>{files}: {len(payload['code'])} chars</p></body></html>"}
+
+    def review_once(self, key, payload):
+        """Review a payload, or wait for and return the review already started under the same key"""
+        if not key:
+            return self.review(payload)
+        with self.lock:
+            entry = self.keys.get(key)
+            owner = entry is None
+            if owner:
+                entry = self.keys[key] = {'done': threading.Event()}
+        if owner:
+            entry['result'] = self.review(payload)
+            entry['done'].set()
+        entry['done'].wait()
+        return entry['result']
+
+class MockHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_event_stream(self, payload, findings=3):
+        """Stream a review as server-sent events, one finding per event, spread over the latency"""
+        with self.server.lock:
+            self.server.reviews += 1
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        events = [json.dumps({'html': f'<p>Finding {i + 1} of {findings}</p>'}) for i in range(findings)] + ['[DONE]']
+        for data in events:
+            time.sleep(self.server.latency / findings if data != '[DONE]' else 0)
+            chunk = f'data: {data}\n\n'.encode('utf-8')
+            self.wfile.write(f'{len(chunk):x}\r\n'.encode('ascii') + chunk + b'\r\n')
+            self.wfile.flush()
+        self.wfile.write(b'0\r\n\r\n')
+
+    def read_payload(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        return json.loads(body)
+
+    def do_POST(self):
+        key = self.headers.get('Idempotency-Key')
+        if self.path == '/review/review' and self.server.stream and 'text/event-stream' in self.headers.get('Accept', ''):
+            self.send_event_stream(self.read_payload())
+        elif self.path == '/review/review':
+            self.send_json(200, self.server.review_once(key, self.read_payload()))
+        elif self.path == '/review/jobs' and self.server.jobs_enabled:
+            payload = self.read_payload()
+            with self.server.lock:
+                job_id = self.server.keys.get(('job', key))
+                if job_id:
+                    # A resubmission of a known job
+                    self.send_json(202, {'job_id': job_id, 'poll_after': 0.1})
+                    return
+                job_id = uuid.uuid4().hex
+                job = {'status': 'pending'}
+                self.server.submissions += 1
+                self.server.jobs[job_id] = job
+                if key:
+                    self.server.keys[('job', key)] = job_id
+
+            def work():
+                job['result'] = self.server.review(payload)
+                job['status'] = 'done'
+            threading.Thread(target=work, daemon=True).start()
+            self.send_json(202, {'job_id': job_id, 'poll_after': 0.1})
+        else:
+            self.send_json(404, {'detail': 'Not Found'})
+
+    def do_GET(self):
+        parts = urllib.parse.urlsplit(self.path)
+        job_id = parts.path.rsplit('/', 1)[-1]
+        job = self.server.jobs.get(job_id)
+        if not parts.path.startswith('/review/jobs/') or job is None:
+            self.send_json(404, {'detail': 'Not Found'})
+            return
+        with self.server.lock:
+            drop = self.server.drop_polls > 0
+            self.server.drop_polls -= drop
+        if drop:
+            # Like a proxy cutting an idle connection
+            self.close_connection = True
+            return
+
+        wait = float(urllib.parse.parse_qs(parts.query).get('wait', ['0'])[0])
+        deadline = time.time() + min(wait, 30)
+        while job['status'] == 'pending' and time.time() < deadline:
+            time.sleep(0.05)
+        self.send_json(200, job)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(args):
+    server = MockBackend(args.port, args.latency, not args.no_jobs, args.drop_polls, args.stream)
+    print(f"Mock review backend on {server.url} (Ctrl+C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+def run_check(name, hook, server, settings, func):
+    """Run one scenario against a fresh backend and ~/.genie"""
+    home = tempfile.mkdtemp(prefix='genie-check-')
+    saved = dict(os.environ)
+    os.environ.update(HOME=home, **settings)
+    hook._git_config_cache = {}
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        problem = func(hook, server)
+    except Exception as e:
+        problem = f"{type(e).__name__}: {e}"
+    finally:
+        server.shutdown()
+        server.server_close()
+        os.environ.clear()
+        os.environ.update(saved)
+    print(f"{'FAIL' if problem else 'ok  '} {name}" + (f": {problem}" if problem else ''))
+    return not problem
+
+def review(hook, server):
+    return hook.send_for_review('diff --git a/x.py b/x.py\n+print(1)\n', 'python', 'repo', 'main', server.url, 'token')
+
+def check_job_roundtrip(hook, server):
+    response = review(hook, server)
+    if not response or 'Review' not in response:
+        return f"unexpected response {response!r}"
+    if (server.submissions, server.reviews) != (1, 1):
+        return f"{server.submissions} submissions, {server.reviews} reviews"
+
+def check_dropped_polls(hook, server):
+    response = review(hook, server)
+    if not response:
+        return "no response after dropped polls"
+    if server.submissions != 1:
+        return f"resubmitted: {server.submissions} submissions"
+
+def check_resume_job(hook, server):
+    # The first run gives up before the review is done; the second picks the same job up
+    os.environ['GENIE_JOB_TIMEOUT'] = '0'
+    if review(hook, server) is not None:
+        return "first run should have given up"
+    del os.environ['GENIE_JOB_TIMEOUT']
+    response = review(hook, server)
+    if not response:
+        return "no response when resuming"
+    if (server.submissions, server.reviews) != (1, 1):
+        return f"{server.submissions} submissions, {server.reviews} reviews"
+
+def check_timeout_retry(hook, server):
+    # Reviews take 1.5 s but the client gives up after 1 s and retries with the same key
+    response = review(hook, server)
+    if not response:
+        return "no response after the retry"
+    if server.reviews != 1:
+        return f"{server.reviews} reviews for one payload"
+
+def check_job_resubmit(hook, server):
+    # Losing the job ID (e.g. ~/.genie/jobs cleared) still finds the submitted job
+    os.environ['GENIE_JOB_TIMEOUT'] = '0'
+    review(hook, server)
+    del os.environ['GENIE_JOB_TIMEOUT']
+    for name in os.listdir(hook.get_genie_dir('jobs')):
+        os.remove(hook.get_genie_dir('jobs', name))
+    if not review(hook, server) or (server.submissions, server.reviews) != (1, 1):
+        return f"{server.submissions} submissions, {server.reviews} reviews"
+
+def check_streamed_report(hook, server):
+    # The live page must open with the first finding, well before the 1.5 s review is over
+    opened = []
+    browser_open = webbrowser.open
+    webbrowser.open = lambda url: opened.append(time.monotonic())
+    hook._live_report = hook.start_live_report()
+    try:
+        started = time.monotonic()
+        response = review(hook, server)
+        finished = time.monotonic()
+    finally:
+        webbrowser.open = browser_open
+        hook._live_report = None
+    if not response or response.count('Finding') != 3:
+        return f"incomplete streamed review {response!r}"
+    if not opened or opened[0] - started > (finished - started) / 2:
+        return "the report was not opened before the review finished"
+
+def check_no_job_api(hook, server):
+    response = review(hook, server)
+    if not response or server.reviews != 1:
+        return f"no blocking fallback: {response!r}"
+
+def stop_index_watchers(repo):
+    """Stop the --watch processes started in a repository (Linux only)"""
+    for pid in filter(str.isdigit, os.listdir('/proc') if os.path.isdir('/proc') else []):
+        try:
+            with open(f'/proc/{pid}/cmdline', 'rb') as f:
+                watching = b'--watch' in f.read().split(b'\0')
+            if watching and os.readlink(f'/proc/{pid}/cwd') == repo:
+                os.kill(int(pid), 15)
+        except OSError:
+            pass
+
+def wait_for(condition, timeout):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.1)
+    return condition()
+
+def check_watcher_after_commit(hook, server):
+    # A watcher started by `commit -a` must not keep the commit's temporary index
+    genie_dir = os.path.join(os.environ['HOME'], '.genie')
+    os.makedirs(genie_dir)
+    for name, content in (('token', 'token'), ('config', server.url)):
+        with open(os.path.join(genie_dir, name), 'w') as f:
+            f.write(content)
+    repo = os.path.realpath(tempfile.mkdtemp(prefix='genie-check-repo-'))
+    
+    def git(*args):
+        subprocess.run(['git', '-c', 'user.name=Check', '-c', 'user.email=check@example.com', *args],
+                       cwd=repo, check=True, stdout=subprocess.DEVNULL)
+    
+    def write(name, content):
+        with open(os.path.join(repo, name), 'w') as f:
+            f.write(content)
+    
+    git('init', '-q')
+    write('a.py', 'a = 1\n')
+    write('b.py', 'b = 1\n')
+    git('add', '.')
+    git('commit', '-q', '-m', 'initial')
+    # A pre-commit hook that only starts the watcher, as the hook does with speculativeReview
+    start = f'import sys; sys.path.insert(0, {os.path.dirname(os.path.abspath(__file__))!r}); ' \
+            'from benchmark_hooks import load_hook; load_hook("pre-commit").start_index_watcher()'
+    write('.git/hooks/pre-commit', f'#!/bin/sh\nexec {shlex.quote(sys.executable)} -c {shlex.quote(start)}\n')
+    os.chmod(os.path.join(repo, '.git/hooks/pre-commit'), 0o755)
+    try:
+        write('a.py', 'a = 2\n')
+        git('commit', '-qam', 'change a')
+        # The commit leaves nothing staged, so the settled index is not reviewed
+        time.sleep(1.5)
+        if server.reviewed_files:
+            return f"reviewed {server.reviewed_files} after the commit"
+        write('b.py', 'b = 2\n')
+        git('add', 'b.py')
+        if not wait_for(lambda: server.reviewed_files, 10):
+            return "the staged change was not reviewed"
+        if server.reviewed_files != [['b.py']]:
+            return f"reviewed {server.reviewed_files} instead of b.py"
+    finally:
+        stop_index_watchers(repo)
+
+def check(args):
+    hook = load_hook("pre-commit")
+    jobs = {'GENIE_REVIEW_JOBS': 'auto'}
+    results = [
+        run_check("job submitted once and polled to completion", hook, MockBackend(0, 0.5), jobs,
+                  check_job_roundtrip),
+        run_check("dropped polls resume the same job", hook, MockBackend(0, 0.5, drop_polls=2), jobs,
+                  check_dropped_polls),
+        run_check("an interrupted run resumes its job", hook, MockBackend(0, 0.5), jobs,
+                  check_resume_job),
+        run_check("backend without the job API gets a blocking request", hook, MockBackend(0, jobs=False), jobs,
+                  check_no_job_api),
+        run_check("a request retried after a timeout costs one review", hook, MockBackend(0, 1.5),
+                  {'GENIE_REQUEST_TIMEOUT': '1'}, check_timeout_retry),
+        run_check("a resubmitted job is not reviewed again", hook, MockBackend(0, 0.5), jobs,
+                  check_job_resubmit),
+        run_check("a streamed review opens the report on the first finding", hook, MockBackend(0, 1.5, stream=True),
+                  {'GENIE_STREAM_REPORT': '1'}, check_streamed_report),
+        run_check("a watcher started by commit -a reviews the real index", hook, MockBackend(0), {
+                  'GENIE_WATCH_DEBOUNCE_MS': '200'}, check_watcher_after_commit),
+    ]
+    return 0 if all(results) else 1
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the Genie review backend")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = subparsers.add_parser("serve", help="run the mock backend")
+    serve_parser.add_argument("--port", type=int, default=8765)
+    serve_parser.add_argument("--latency", type=float, default=0.0, help="seconds per review")
+    serve_parser.add_argument("--no-jobs", action="store_true", help="answer 404 for the job API")
+    serve_parser.add_argument("--drop-polls", type=int, default=0, help="drop this many job polls")
+    serve_parser.add_argument("--stream", action="store_true", help="stream reviews as server-sent events")
+    serve_parser.set_defaults(func=serve)
+
+    check_parser = subparsers.add_parser("check", help="run the hook's client against the mock backend")
+    check_parser.set_defaults(func=check)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+if __name__ == "__main__":
+    sys.exit(main())